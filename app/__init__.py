@@ -66,6 +66,11 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint (api_bp, url_prefix='/api')
 
+    if app.config['SEED_ON_STARTUP']:
+        from app.custom_libs.utilities_lib import seed_database
+        with app.app_context ():
+            seed_database ()
+
     if not app.debug and not app.testing:
         if app.config['MAIL_SERVER']:
             auth = None
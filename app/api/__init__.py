@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('api', __name__)
 
-from app.api import users, proposals, errors, tokens
+from app.api import users, proposals, errors, tokens, analytics
@@ -0,0 +1,14 @@
+from flask import jsonify, g
+from app.models import ACCESS
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import error_response
+from app.custom_libs.analytics_lib import get_portfolio_summary
+
+
+@bp.route('/analytics', methods=['GET'])
+@token_auth.login_required
+def get_analytics():
+    if not g.current_user.allowed(ACCESS['admin']):
+        return error_response(403)
+    return jsonify(get_portfolio_summary())
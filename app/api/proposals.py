@@ -4,14 +4,16 @@ from app.models import User, Proposal
 from app.api import bp
 from app.api.auth import token_auth
 from app.api.errors import bad_request
+from app.custom_libs.utilities_lib import conditional_response
 
 
 @bp.route('/proposals/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_proposal(id):
-    proposal = Proposal.query.get(id)
+    proposal = Proposal.query.get_or_404(id)
     if proposal.user_is_included(g.current_user):
-        return jsonify(Proposal.query.get_or_404(id).to_dict())
+        return conditional_response((proposal.get_transaction_id(), 'proposal'),
+                                    lambda: jsonify(proposal.to_dict()))
     else:
         return bad_request('user not allowed')
 
@@ -20,8 +22,17 @@ def get_proposal(id):
 @bp.route('/proposals', methods=['GET'])
 @token_auth.login_required
 def get_proposals():
-    page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 25, type=int), 100)
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            data = Proposal.to_cursor_dict(Proposal.query, after, per_page, 'api.get_proposals',
+                                           sort=request.args.get('sort', 'id'),
+                                           with_total=request.args.get('with_total', 0, type=int) == 1)
+        except ValueError as e:
+            return bad_request(str(e))
+        return jsonify(data)
+    page = request.args.get('page', 1, type=int)
     data = Proposal.to_collection_dict(Proposal.query, page, per_page, 'api.get_proposals')
     return jsonify(data)
 
@@ -34,9 +45,9 @@ def get_wps(id):
     proposal = Proposal.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 25, type=int), 100)
-    data = Proposal.to_collection_dict(proposal.working_packages, page, per_page,
-                                       'api.get_wps', id=id)
-    return jsonify(data)
+    return conditional_response((proposal.get_transaction_id(), 'wps', page, per_page),
+                                lambda: jsonify(Proposal.to_collection_dict(proposal.working_packages, page, per_page,
+                                                                            'api.get_wps', id=id)))
 #
 #
 # @bp.route('/users/<int:id>/followed', methods=['GET'])
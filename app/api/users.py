@@ -15,8 +15,17 @@ def get_user(id):
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            data = User.to_cursor_dict(User.query, after, per_page, 'api.get_users',
+                                       sort=request.args.get('sort', 'id'),
+                                       with_total=request.args.get('with_total', 0, type=int) == 1)
+        except ValueError as e:
+            return bad_request(str(e))
+        return jsonify(data)
+    page = request.args.get('page', 1, type=int)
     data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
     return jsonify(data)
 
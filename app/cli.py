@@ -1,8 +1,108 @@
+import json
 import os
+import time
+
 import click
 
+from app.custom_libs.pandoc_lib import EXPORT_FORMATS
 
 def register(app):
+    @app.cli.command()
+    def seed():
+        """Create the admin user and the default proposal statuses."""
+        from app.custom_libs.utilities_lib import seed_database
+        if not seed_database():
+            raise RuntimeError('seed command failed')
+
+    @app.cli.group()
+    def cache():
+        """Dashboard fragments cache commands."""
+        pass
+
+    @cache.command()
+    def stats():
+        """Show the fragments cache hit/miss counters."""
+        from app.custom_libs.cache_lib import get_fragment_stats
+        for name, counters in sorted(get_fragment_stats().items()):
+            total = counters['hit'] + counters['miss']
+            click.echo(f'{name}: {counters["hit"]} hits, {counters["miss"]} misses '
+                       f'({100 * counters["hit"] / total if total else 0:.1f}% hit rate)')
+
+    @app.cli.group()
+    def export():
+        """Proposal export commands."""
+        pass
+
+    @export.command()
+    @click.argument('output', type=click.File('wb'))
+    @click.option('--format', default='odt', show_default=True, type=click.Choice(EXPORT_FORMATS),
+                  help='Export format of every proposal.')
+    @click.option('--call', help='Only export the proposals of this call.')
+    @click.option('--status', help='Only export the proposals with this status.')
+    def bulk(output, format, call, status):
+        """Export the selected proposals to a ZIP archive."""
+        from app.custom_libs.print_lib import iter_bulk_export
+        from app.models import Proposal
+        proposals = Proposal.get_proposals_query(status=status, call=call).order_by(Proposal.acronym).all()
+        for chunk in iter_bulk_export(proposals, format):
+            output.write(chunk)
+        click.echo(f'{len(proposals)} proposals exported to {output.name}')
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.option('--model', 'models', multiple=True, help='Only reindex this model index (repeatable).')
+    @click.option('--chunk-size', default=500, show_default=True, help='Rows read and sent per bulk request.')
+    @click.option('--workers', default=os.cpu_count() or 1, show_default=True,
+                  help='Processes building the bulk payloads.')
+    @click.option('--checkpoint', default='search-reindex.json', show_default=True,
+                  type=click.Path(dir_okay=False), help='File recording the progress of the reindex.')
+    @click.option('--resume', is_flag=True, help='Resume the reindex recorded in the checkpoint.')
+    def reindex(models, chunk_size, workers, checkpoint, resume):
+        """Rebuild the search index of the searchable models."""
+        from app.models import SEARCHABLE_MODELS
+        from app.search import reindex as reindex_model
+        unknown = set(models) - set(SEARCHABLE_MODELS)
+        if unknown:
+            raise click.BadParameter(f'unknown models {", ".join(sorted(unknown))}, '
+                                     f'choose between {", ".join(SEARCHABLE_MODELS)}', param_hint='--model')
+        state = {}
+        if resume and os.path.exists(checkpoint):
+            with open(checkpoint) as file:
+                state = json.load(file)
+
+        def save_state():
+            with open(f'{checkpoint}.tmp', 'w') as file:
+                json.dump(state, file)
+            os.replace(f'{checkpoint}.tmp', checkpoint)
+
+        total, started = 0, time.monotonic()
+        for name in models or SEARCHABLE_MODELS:
+            progress = state.setdefault(name, {'after': 0, 'done': False})
+            if progress['done']:
+                click.echo(f'{name}: already indexed')
+                continue
+            counter = {'documents': 0, 'started': time.monotonic()}
+
+            def on_chunk(last_id, count):
+                progress['after'] = last_id
+                save_state()
+                counter['documents'] += count
+                elapsed = time.monotonic() - counter['started']
+                click.echo(f'{name}: {counter["documents"]} documents up to id {last_id} '
+                           f'({counter["documents"] / elapsed if elapsed else 0:.0f} docs/sec)')
+
+            total += reindex_model(SEARCHABLE_MODELS[name], chunk_size, workers, after=progress['after'],
+                                   on_chunk=on_chunk)
+            progress['done'] = True
+            save_state()
+        os.remove(checkpoint)
+        elapsed = time.monotonic() - started
+        click.echo(f'{total} documents indexed in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} docs/sec)')
+
     @app.cli.group()
     def translate():
         """Translation and localization commands."""
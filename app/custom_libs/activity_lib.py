@@ -0,0 +1,47 @@
+import threading
+from datetime import datetime
+from time import time
+
+from flask import current_app
+from sqlalchemy import bindparam
+
+from app import db
+from app.models import User
+
+
+class ActivityTracker:
+    ''' Write-behind tracker of User.last_seen.
+    Requests only record the activity in memory; the pending timestamps are flushed in a single batched
+    UPDATE at most once every LAST_SEEN_FLUSH_INTERVAL seconds, so read requests stop writing the user row.
+    A crashed worker loses at most one interval of last_seen updates. '''
+
+    def __init__(self):
+        self.pending = {}
+        self.last_flush = time()
+        self.lock = threading.Lock()
+
+    def touch(self, user_id):
+        with self.lock:
+            self.pending[user_id] = datetime.utcnow()
+            due = time() - self.last_flush >= current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time()
+        if not pending:
+            return 0
+        table = User.__table__
+        statement = table.update().where(table.c.id == bindparam('user_id')).values(last_seen=bindparam('seen'))
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(statement, [{'user_id': key, 'seen': value} for key, value in pending.items()])
+        except Exception as e:
+            current_app.logger.warning(f'last_seen flush failed: {e}')
+            return 0
+        return len(pending)
+
+
+activity_tracker = ActivityTracker()
@@ -0,0 +1,85 @@
+import json
+
+from flask import current_app
+from redis.exceptions import RedisError
+from sqlalchemy import and_, case, distinct, func
+from sqlalchemy_continuum import versioning_manager
+
+from app import db
+from app.custom_libs.budget_lib import REDUCED_RATE, REDUCED_RATE_ACTIONS, REDUCED_RATE_COMPANIES
+from app.custom_libs.cache_lib import companies_generation
+from app.models import Association, Company, Proposal, ProposalStatus
+
+# --------------- Portfolio analytics ------------------------#
+# Totals across proposals are computed with GROUP BY queries; the summary is cached in app.redis under the
+# latest SQLAlchemy-Continuum transaction of the whole database, so any versioned write invalidates it.
+
+PREFIX = 'analytics'
+
+
+def contribution_sum():
+    ''' SQL expression of the requested EU contribution, same rules as budget_lib.Budget '''
+    personnel = func.coalesce(Association.personnel_cost, 0)
+    other = func.coalesce(Association.other_direct_costs, 0)
+    subcontracting = func.coalesce(Association.subcontracting_cost, 0)
+    total = (personnel + other) * (1 + func.coalesce(Proposal.indirect_costs_rate, 0)) + subcontracting
+    rate = case([(and_(Proposal.action_type.in_(REDUCED_RATE_ACTIONS),
+                       Company.company_type.in_(REDUCED_RATE_COMPANIES)), REDUCED_RATE)], else_=1.0)
+    return func.coalesce(func.sum(total * rate), 0).label('contribution')
+
+
+def proposals_query(*columns):
+    return db.session.query(*columns, func.count(distinct(Proposal.id)).label('proposals'), contribution_sum()) \
+        .select_from(Proposal) \
+        .outerjoin(Association, Association.proposal_id == Proposal.id) \
+        .outerjoin(Company, Company.id == Association.company_id)
+
+
+def contribution_by_status():
+    rows = proposals_query(ProposalStatus.status) \
+        .outerjoin(ProposalStatus, ProposalStatus.id == Proposal.status_id) \
+        .group_by(ProposalStatus.status).order_by(ProposalStatus.status).all()
+    return [dict(status=status, proposals=proposals, contribution=float(contribution))
+            for status, proposals, contribution in rows]
+
+
+def contribution_by_call():
+    rows = proposals_query(Proposal.call).group_by(Proposal.call).order_by(Proposal.call).all()
+    return [dict(call=call, proposals=proposals, contribution=float(contribution))
+            for call, proposals, contribution in rows]
+
+
+def contribution_by_company():
+    rows = db.session.query(Company.acronym, Company.name, func.count(distinct(Proposal.id)).label('proposals'),
+                            contribution_sum()) \
+        .select_from(Association) \
+        .join(Proposal, Proposal.id == Association.proposal_id) \
+        .join(Company, Company.id == Association.company_id) \
+        .group_by(Company.id, Company.acronym, Company.name) \
+        .order_by(Company.acronym).all()
+    return [dict(acronym=acronym, name=name, proposals=proposals, contribution=float(contribution))
+            for acronym, name, proposals, contribution in rows]
+
+
+def get_portfolio_version():
+    transaction = versioning_manager.transaction_cls
+    return f'{db.session.query(func.max(transaction.id)).scalar() or 0}:{companies_generation()}'
+
+
+def get_portfolio_summary():
+    key = f'{PREFIX}:{get_portfolio_version()}'
+    try:
+        cached = current_app.redis.get(key)
+    except RedisError as e:
+        current_app.logger.warning(f'Analytics cache unavailable: {e}')
+        cached = None
+    if cached is not None:
+        return json.loads(cached)
+
+    summary = dict(by_status=contribution_by_status(), by_call=contribution_by_call(),
+                   by_company=contribution_by_company())
+    try:
+        current_app.redis.setex(key, current_app.config['ANALYTICS_CACHE_TTL'], json.dumps(summary))
+    except RedisError:
+        pass
+    return summary
@@ -0,0 +1,97 @@
+from bisect import bisect_left
+
+from flask import current_app, has_app_context
+from redis.exceptions import RedisError
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session
+
+from app import db
+from app.models import Proposal
+
+# --------------- Autocomplete ------------------------#
+# Each process keeps a sorted, deduplicated prefix index of the proposal calls and topics, built with a
+# DISTINCT query on first use. Proposal writes that change a call or topic are recorded on the session
+# during the flush, and once committed bump a generation counter in app.redis (and clear the local indexes),
+# so every process rebuilds its index on the next lookup and never from uncommitted rows.
+
+FIELDS = ('call', 'topic')
+GENERATION_KEY = 'autocomplete:proposals'
+CHANGED_KEY = 'autocomplete_changed'
+
+_indexes = {}
+
+
+class PrefixIndex:
+    ''' Case insensitive prefix lookups by bisection over the sorted values '''
+
+    def __init__(self, values):
+        entries = sorted({(x.lower(), x) for x in values if x})
+        self.keys = [x[0] for x in entries]
+        self.values = [x[1] for x in entries]
+
+    def __len__(self):
+        return len(self.values)
+
+    def match(self, prefix, limit):
+        prefix = prefix.lower()
+        start = bisect_left(self.keys, prefix)
+        result = []
+        for key, value in zip(self.keys[start:start + limit], self.values[start:start + limit]):
+            if not key.startswith(prefix):
+                break
+            result.append(value)
+        return result
+
+
+def generation():
+    try:
+        return int(current_app.redis.get(GENERATION_KEY) or 0)
+    except RedisError:
+        return 0
+
+
+def get_index(field):
+    current = generation()
+    cached = _indexes.get(field)
+    if cached is None or cached[0] != current:
+        cached = _indexes[field] = (current, PrefixIndex(Proposal.get_distinct_values(field)))
+    return cached[1]
+
+
+def complete(field, prefix, limit):
+    ''' Up to limit values of the field starting with prefix, in alphabetical order '''
+    return get_index(field).match(prefix, limit)
+
+
+def invalidate():
+    _indexes.clear()
+    try:
+        current_app.redis.incr(GENERATION_KEY)
+    except RedisError:
+        pass
+
+
+def record_change(mapper, connection, target):
+    object_session(target).info[CHANGED_KEY] = True
+
+
+def record_changed_fields(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[x].history.has_changes() for x in FIELDS):
+        record_change(mapper, connection, target)
+
+
+def after_commit(session):
+    if session.info.pop(CHANGED_KEY, False) and has_app_context():
+        invalidate()
+
+
+def after_rollback(session):
+    session.info.pop(CHANGED_KEY, None)
+
+
+event.listen(Proposal, 'after_insert', record_change)
+event.listen(Proposal, 'after_update', record_changed_fields)
+event.listen(Proposal, 'after_delete', record_change)
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
@@ -0,0 +1,79 @@
+import numpy as np
+
+# --------------- Budget engine ------------------------#
+# Participant cost columns are loaded into arrays and indirect costs, totals, reimbursement rates and
+# contributions are computed in batched operations, for one proposal or for the whole portfolio at once.
+
+# Row layout expected by Budget
+COLUMNS = ('proposal_id', 'participant_number', 'acronym', 'country', 'company_type', 'personnel_cost',
+           'other_direct_costs', 'subcontracting_cost', 'indirect_costs_rate', 'action_type')
+
+# Company types reimbursed at REDUCED_RATE in Innovation Actions
+REDUCED_RATE_ACTIONS = ['IA']
+REDUCED_RATE_COMPANIES = ['Large', 'SME']
+REDUCED_RATE = 0.7
+
+
+def to_array(values):
+    ''' Float array where missing (None) costs count as zero '''
+    return np.nan_to_num(np.array(values, dtype=float))
+
+
+class Budget:
+    def __init__(self, rows):
+        columns = dict(zip(COLUMNS, zip(*rows))) if rows else {x: () for x in COLUMNS}
+        self.proposal_id = np.array(columns['proposal_id'], dtype=np.int64)
+        self.participant_number = list(columns['participant_number'])
+        self.acronym = list(columns['acronym'])
+        self.country = list(columns['country'])
+        self.personnel_cost = to_array(columns['personnel_cost'])
+        self.other_direct_costs = to_array(columns['other_direct_costs'])
+        self.subcontracting_cost = to_array(columns['subcontracting_cost'])
+        self.indirect_costs_rate = to_array(columns['indirect_costs_rate'])
+
+        action_type = np.array(columns['action_type'], dtype=object)
+        company_type = np.array(columns['company_type'], dtype=object)
+        reduced = np.isin(action_type, REDUCED_RATE_ACTIONS) & np.isin(company_type, REDUCED_RATE_COMPANIES)
+        self.reimbursement_rate = np.where(reduced, REDUCED_RATE, 1.0)
+
+        self.indirect_costs = (self.personnel_cost + self.other_direct_costs) * self.indirect_costs_rate
+        self.total_costs = self.personnel_cost + self.other_direct_costs + self.indirect_costs + \
+            self.subcontracting_cost
+        self.contribution = self.total_costs * self.reimbursement_rate
+
+    def __len__(self):
+        return len(self.acronym)
+
+    @classmethod
+    def from_participants(cls, proposal, participants):
+        ''' Budget of one proposal from its (already loaded) Association rows '''
+        return cls([(proposal.id, x.participant_number, x.company.acronym, x.company.country, x.company.company_type,
+                     x.personnel_cost, x.other_direct_costs, x.subcontracting_cost, proposal.indirect_costs_rate,
+                     proposal.action_type) for x in participants])
+
+    @classmethod
+    def from_query(cls, query):
+        ''' Budget of any set of proposals from a query returning rows in the COLUMNS order '''
+        return cls(query.all())
+
+    def sum_by_proposal(self, values):
+        ''' {proposal_id: sum of values} '''
+        ids, inverse = np.unique(self.proposal_id, return_inverse=True)
+        totals = np.bincount(inverse, weights=values, minlength=len(ids))
+        return dict(zip(ids.tolist(), totals.tolist()))
+
+    def remaining(self, budgets):
+        ''' {proposal_id: budget - assigned contributions} for the given {proposal_id: budget} '''
+        assigned = self.sum_by_proposal(self.contribution)
+        return {key: (value or 0) - assigned.get(key, 0) for key, value in budgets.items()}
+
+    def rows(self):
+        ''' One dict per participant, with the keys used by the budget tables '''
+        return [dict(participant_number=number, participant=acronym, country=country, personnel_costs=personnel,
+                     other_direct_costs=other, subcontracting_costs=subcontracting, indirect_costs=indirect,
+                     total_costs=total, reimbursement_rate=rate, contribution=contribution)
+                for number, acronym, country, personnel, other, subcontracting, indirect, total, rate, contribution
+                in zip(self.participant_number, self.acronym, self.country, self.personnel_cost.tolist(),
+                       self.other_direct_costs.tolist(), self.subcontracting_cost.tolist(),
+                       self.indirect_costs.tolist(), self.total_costs.tolist(),
+                       np.rint(self.reimbursement_rate * 100).astype(int).tolist(), self.contribution.tolist())]
@@ -0,0 +1,108 @@
+from flask import current_app, has_app_context
+from markupsafe import Markup
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from app import db
+from app.models import Company, ProposalGraph
+
+# --------------- Dashboard fragments cache ------------------------#
+# Rendered fragments are stored in app.redis under the proposal version key, built from the latest
+# SQLAlchemy-Continuum transaction of the proposal: any edit changes the key, so stale fragments are never
+# read and simply expire. Companies are not versioned: their edits are flagged on the session during the flush
+# and, once committed, bump a generation counter instead.
+
+PREFIX = 'fragment'
+STATS_KEY = f'{PREFIX}:stats'
+COMPANIES_KEY = f'{PREFIX}:companies'
+COMPANIES_CHANGED_KEY = 'companies_changed'
+
+
+def companies_generation():
+    try:
+        return int(current_app.redis.get(COMPANIES_KEY) or 0)
+    except RedisError:
+        return 0
+
+
+def bump_companies_generation():
+    try:
+        current_app.redis.incr(COMPANIES_KEY)
+    except RedisError:
+        pass
+
+
+def record_company_change(mapper, connection, target):
+    object_session(target).info[COMPANIES_CHANGED_KEY] = True
+
+
+def after_commit(session):
+    if session.info.pop(COMPANIES_CHANGED_KEY, False) and has_app_context():
+        bump_companies_generation()
+
+
+def after_rollback(session):
+    session.info.pop(COMPANIES_CHANGED_KEY, None)
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Company, _event, record_company_change)
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
+
+
+def to_text(fragment):
+    ''' Builders return either html strings or bytes blobs (chart configs) '''
+    if isinstance(fragment, bytes):
+        return fragment.decode('utf-8')
+    return fragment
+
+
+def get_version_key(proposal):
+    return f'{proposal.id}:{proposal.get_transaction_id()}:{companies_generation()}'
+
+
+def get_fragments(proposal, builders, version_key=None):
+    ''' Returns {name: Markup} for the given {name: builder(graph)} dict.
+    Only the missing fragments are built, and the proposal graph is loaded only if one is missing. '''
+    version_key = version_key or get_version_key(proposal)
+    names = list(builders)
+    keys = [f'{PREFIX}:{version_key}:{name}' for name in names]
+    try:
+        cached = current_app.redis.mget(keys)
+    except RedisError as e:
+        current_app.logger.warning(f'Fragment cache unavailable: {e}')
+        graph = ProposalGraph(proposal)
+        return {name: Markup(to_text(builder(graph))) for name, builder in builders.items()}
+
+    fragments = dict()
+    missing = [(name, key) for name, key, value in zip(names, keys, cached) if value is None]
+    for name, value in zip(names, cached):
+        if value is not None:
+            fragments[name] = Markup(value.decode('utf-8'))
+    if missing:
+        graph = ProposalGraph(proposal)
+        for name, key in missing:
+            fragments[name] = Markup(to_text(builders[name](graph)))
+
+    try:
+        pipe = current_app.redis.pipeline()
+        for name, key in missing:
+            pipe.setex(key, current_app.config['FRAGMENT_CACHE_TTL'], str(fragments[name]))
+        missing_names = [name for name, key in missing]
+        for name in names:
+            pipe.hincrby(STATS_KEY, f'{name}:{"miss" if name in missing_names else "hit"}', 1)
+        pipe.execute()
+    except RedisError as e:
+        current_app.logger.warning(f'Fragment cache unavailable: {e}')
+    return fragments
+
+
+def get_fragment_stats():
+    ''' {fragment name: {'hit': n, 'miss': n}} '''
+    stats = dict()
+    for key, value in current_app.redis.hgetall(STATS_KEY).items():
+        name, kind = key.decode('utf-8').rsplit(':', 1)
+        stats.setdefault(name, {'hit': 0, 'miss': 0})[kind] = int(value)
+    return stats
@@ -0,0 +1,42 @@
+import calendar
+from datetime import datetime
+
+from dateutil import tz
+from dateutil.relativedelta import relativedelta
+
+
+def to_timestamp(day):
+    ''' Epoch milliseconds of the (local) midnight of the given day, as expected by Highcharts '''
+    start = datetime.combine(day, datetime.min.time())
+    return calendar.timegm(start.astimezone(tz.UTC).utctimetuple()) * 1000
+
+
+class ProposalCalendar:
+    ''' Date and epoch-millisecond timestamp of every project month, computed once per proposal.
+    Offsets beyond the proposal duration (e.g. the end of a deliverable due in the last month) are computed
+    on first use and memoised. '''
+
+    def __init__(self, start_date, duration_months):
+        self.start_date = start_date
+        self.dates = [start_date + relativedelta(months=x) for x in range((duration_months or 0) + 1)]
+        self.timestamps = [to_timestamp(x) for x in self.dates]
+        self.extra = dict()
+
+    def __repr__(self):
+        return f'<Calendar {self.start_date} {len(self.dates)} months>'
+
+    def _extra(self, month):
+        if month not in self.extra:
+            day = self.start_date + relativedelta(months=month)
+            self.extra[month] = (day, to_timestamp(day))
+        return self.extra[month]
+
+    def date(self, month):
+        if 0 <= month < len(self.dates):
+            return self.dates[month]
+        return self._extra(month)[0]
+
+    def timestamp(self, month):
+        if 0 <= month < len(self.timestamps):
+            return self.timestamps[month]
+        return self._extra(month)[1]
@@ -0,0 +1,124 @@
+import re
+
+from sqlalchemy import DDL, and_, bindparam, event, func, select, text
+
+from app import db
+
+# --------------- Local full-text index ------------------------#
+# Search backend used when ELASTICSEARCH_URL is not set: the searchable documents are stored in the
+# search_document table of the primary database, indexed by an FTS5 external content table on SQLite
+# (kept in sync by triggers) and by a FULLTEXT index on MySQL. Other databases fall back to LIKE matching.
+# Every query term is matched as a prefix, and all the terms must match.
+
+search_document = db.Table(
+    'search_document',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('index_name', db.String(64), nullable=False),
+    db.Column('doc_id', db.Integer, nullable=False),
+    db.Column('content', db.Text),
+    db.UniqueConstraint('index_name', 'doc_id'))
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_document_fts USING fts5("
+    "content, content='search_document', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS search_document_ai AFTER INSERT ON search_document BEGIN "
+    "INSERT INTO search_document_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS search_document_ad AFTER DELETE ON search_document BEGIN "
+    "INSERT INTO search_document_fts(search_document_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS search_document_au AFTER UPDATE ON search_document BEGIN "
+    "INSERT INTO search_document_fts(search_document_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO search_document_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+MYSQL_DDL = ['CREATE FULLTEXT INDEX ix_search_document_content ON search_document (content)']
+
+for _statement in SQLITE_DDL:
+    event.listen(search_document, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+event.listen(search_document, 'before_drop', DDL('DROP TABLE IF EXISTS search_document_fts').execute_if(dialect='sqlite'))
+for _statement in MYSQL_DDL:
+    event.listen(search_document, 'after_create', DDL(_statement).execute_if(dialect='mysql'))
+
+TAG_RE = re.compile(r'<[^>]+>')
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def escape_like(term):
+    ''' The term with the LIKE wildcards escaped by a backslash '''
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def to_content(payload):
+    ''' Plain text of the document fields, without the html markup of the rich text fields '''
+    return ' '.join(TAG_RE.sub(' ', str(x)) for x in payload.values() if x)
+
+
+def build_rows(documents):
+    ''' search_document rows of the documents, [(index, id, payload)] '''
+    return [dict(index_name=index, doc_id=id, content=to_content(payload)) for index, id, payload in documents]
+
+
+def insert_rows(rows):
+    ''' Replaces the documents of the rows in the local index. The caller commits '''
+    if not rows:
+        return 0
+    remove_documents([(x['index_name'], x['doc_id']) for x in rows])
+    db.session.execute(search_document.insert(), rows)
+    return len(rows)
+
+
+def index_documents(documents):
+    ''' Replaces the documents, [(index, id, payload)], in the local index. The caller commits '''
+    return insert_rows(build_rows(documents))
+
+
+def remove_documents(removed):
+    ''' Removes the documents, [(index, id)], from the local index. The caller commits '''
+    if not removed:
+        return 0
+    statement = search_document.delete().where(and_(search_document.c.index_name == bindparam('index'),
+                                                    search_document.c.doc_id == bindparam('id')))
+    db.session.execute(statement, [dict(index=index, id=id) for index, id in removed])
+    return len(removed)
+
+
+def clear_index(index):
+    ''' Removes all the documents of the index. The caller commits '''
+    db.session.execute(search_document.delete().where(search_document.c.index_name == index))
+
+
+def query_index(index, query, page, per_page, ids=None):
+    ''' Ids of the ranked matches of the page, and the total number of matches.
+    When given, only the documents with one of the ids are matched, before the page is counted and sliced '''
+    terms = TERM_RE.findall(query.lower())
+    if not terms or (ids is not None and not ids):
+        return [], 0
+    dialect = db.session.get_bind().dialect.name
+    params = dict(index=index, limit=per_page, offset=(page - 1) * per_page)
+    if dialect == 'sqlite':
+        params['match'] = ' '.join(f'"{x}"*' for x in terms)
+        where = 'FROM search_document_fts JOIN search_document d ON d.id = search_document_fts.rowid ' \
+                'WHERE search_document_fts MATCH :match AND d.index_name = :index'
+        order = 'search_document_fts.rank'
+    elif dialect == 'mysql':
+        params['match'] = ' '.join(f'+{x}*' for x in terms)
+        where = 'FROM search_document d ' \
+                'WHERE MATCH (d.content) AGAINST (:match IN BOOLEAN MODE) AND d.index_name = :index'
+        order = 'MATCH (d.content) AGAINST (:match IN BOOLEAN MODE) DESC'
+    else:
+        condition = and_(search_document.c.index_name == index,
+                         *[search_document.c.content.ilike(f'%{escape_like(x)}%', escape='\\') for x in terms])
+        if ids is not None:
+            condition = and_(condition, search_document.c.doc_id.in_(list(ids)))
+        rows = db.session.execute(select([search_document.c.doc_id]).where(condition)
+                                  .order_by(search_document.c.doc_id)
+                                  .limit(per_page).offset((page - 1) * per_page))
+        total = db.session.execute(select([func.count()]).select_from(search_document).where(condition)).scalar()
+        return [x[0] for x in rows], total
+    bindparams = []
+    if ids is not None:
+        where += ' AND d.doc_id IN :ids'
+        params['ids'] = list(ids)
+        bindparams.append(bindparam('ids', expanding=True))
+    rows = db.session.execute(text(f'SELECT d.doc_id {where} ORDER BY {order} LIMIT :limit OFFSET :offset')
+                              .bindparams(*bindparams), params)
+    total = db.session.execute(text(f'SELECT count(*) {where}').bindparams(*bindparams), params).scalar()
+    return [x[0] for x in rows], total
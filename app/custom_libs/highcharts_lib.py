@@ -1,37 +1,52 @@
+import orjson
+
+
 # --------------- Highcharts functions ------------------------#
+# Chart configs are real JSON, encoded with orjson into bytes blobs that can be cached as they are and
+# embedded in the templates with the chart_config filter.
+
+def to_json(config):
+    # '</' is escaped so that titles can never close the embedding <script> tag
+    return orjson.dumps(config, option=orjson.OPT_SERIALIZE_NUMPY).replace(b'</', b'<\\/')
+
 
 def to_highchart(graphtype, series, series_drilldown, title, subtitle, value_label='k€'):
     # title shall be a string
     # graphtype shall be a string indicating the chart type (pie, line, chart, etc
     # series shall be a list
-    chart = {'plotShadow': 'false', 'type': graphtype}
-    title = {'text': title}
-    subtitle = {'text': subtitle}
-    series = series
-    tooltip = {'pointFormat': '{series.name}: <b>{point.percentage:.1f}%</b>'}
-    plotOptions = {graphtype: {'allowPointSelect': 'true', 'cursor': 'pointer', 'dataLabels': {'enabled': 'true',
-                                                                                               'format': '<b>{point.name}</b>: {point.y:.1f} ' + value_label}}}
-    drilldown = {'series': series_drilldown}
-    return '{' + f'chart: {chart}, tooltip: {tooltip}, title: {title}, subtitle: {subtitle}, plotOptions: {plotOptions}, series: {series}, drilldown: {drilldown}' + '}'
+    config = {
+        'chart': {'plotShadow': False, 'type': graphtype},
+        'tooltip': {'pointFormat': '{series.name}: <b>{point.percentage:.1f}%</b>'},
+        'title': {'text': title},
+        'subtitle': {'text': subtitle},
+        'plotOptions': {graphtype: {'allowPointSelect': True, 'cursor': 'pointer',
+                                    'dataLabels': {'enabled': True,
+                                                   'format': '<b>{point.name}</b>: {point.y:.1f} ' + value_label}}},
+        'series': series,
+        'drilldown': {'series': series_drilldown},
+    }
+    return to_json(config)
 
 
 def to_gantt_highchart(series, title, extras=False):
-    title = {'text': title}
-    series = series
-    xAxis = '{minPadding: 0.05, maxPadding: 0.05}'
-    flag = 'false'
-    if extras:
-        flag = 'true'
-    navigator = "{enabled: " + flag + ", liveRedraw: true,series: {type: 'gantt', pointPlacement: 0.5,pointPadding: 0.25}, yAxis: {min: 0,max: 3, reversed: true, categories: []}}"
-    scrollbar = "{enabled: " + flag + "}"
-    rangeSelector = "{enabled: " + flag + ",selected: 0}"
-    return '{' + f'title: {title}, series: {series}, xAxis : {xAxis}, navigator: {navigator}, scrollbar: {scrollbar}, rangeSelector: {rangeSelector}' + '}'
+    config = {
+        'title': {'text': title},
+        'series': series,
+        'xAxis': {'minPadding': 0.05, 'maxPadding': 0.05},
+        'navigator': {'enabled': extras, 'liveRedraw': True,
+                      'series': {'type': 'gantt', 'pointPlacement': 0.5, 'pointPadding': 0.25},
+                      'yAxis': {'min': 0, 'max': 3, 'reversed': True, 'categories': []}},
+        'scrollbar': {'enabled': extras},
+        'rangeSelector': {'enabled': extras, 'selected': 0},
+    }
+    return to_json(config)
 
 
 def to_map_highchart(series, title):
-    title = {'text': title}
-    chart = {'map': 'custom/europe'}
-    legend = '{enabled: false}'
-    series = series
-
-    return '{' + f'chart: {chart}, title: {title}, legend: {legend}, series: {series}' + '}'
+    config = {
+        'chart': {'map': 'custom/europe'},
+        'title': {'text': title},
+        'legend': {'enabled': False},
+        'series': series,
+    }
+    return to_json(config)
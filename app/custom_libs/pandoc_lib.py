@@ -0,0 +1,101 @@
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pypandoc
+from flask import current_app
+
+# --------------- Pandoc conversion pool ------------------------#
+# Conversions run through a bounded pool of PANDOC_WORKERS workers (the CPU count by default) with a queue of
+# PANDOC_QUEUE_SIZE pending jobs. Each conversion is fed the html on stdin, is killed after PANDOC_TIMEOUT
+# seconds and runs with its heap limited to PANDOC_MEMORY_LIMIT_MB, so a runaway conversion can't starve the
+# box. The limit is the -M option of the pandoc (GHC) runtime: an RLIMIT_AS doesn't fit the large address
+# space the runtime reserves at start-up, and a preexec_fn isn't safe in the threads of the pool.
+# The pool keeps no warm pandoc process: the pandoc CLI converts one document per process, so every
+# conversion still pays the pandoc start-up. What the pool provides is bounded, parallel conversions within a
+# process, like the bulk export of a web request or of the CLI, which fan out over the cores.
+# It doesn't bound the single proposal exports either: RQ forks a work-horse for every job, so those run one
+# conversion each and their concurrency is the number of RQ workers started on the box, not PANDOC_WORKERS.
+
+# Export formats that pandoc names differently; pdf is selected by the output file extension
+PANDOC_FORMATS = {'md': 'markdown', 'tex': 'latex', 'pdf': None}
+# Export formats offered to the users, by file extension
+EXPORT_FORMATS = ('odt', 'md', 'pdf', 'tex')
+
+
+class ConversionError(Exception):
+    pass
+
+
+class ConversionPool:
+    def __init__(self, workers, queue_size, timeout, memory_limit_mb):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pandoc')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.pandoc = pypandoc.get_pandoc_path()
+
+    @staticmethod
+    def _discard(outputfile):
+        try:
+            os.remove(outputfile)
+        except OSError:
+            pass
+
+    def _convert(self, html, format, outputfile):
+        try:
+            args = [self.pandoc]
+            if self.memory_limit_mb:
+                args += ['+RTS', f'-M{self.memory_limit_mb}m', '-RTS']
+            args += ['--from', 'html', '--output', outputfile]
+            to = PANDOC_FORMATS.get(format, format)
+            if to:
+                args += ['--to', to]
+            with subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE) as process:
+                try:
+                    _, stderr = process.communicate(html.encode('utf-8'), timeout=self.timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.communicate()
+                    self._discard(outputfile)
+                    raise ConversionError(f'pandoc conversion to {format} timed out after {self.timeout}s')
+            if process.returncode:
+                self._discard(outputfile)
+                raise ConversionError(f'pandoc conversion to {format} failed: {stderr.decode("utf-8", "replace")}')
+            return outputfile
+        finally:
+            self.slots.release()
+
+    def submit(self, html, format, outputfile):
+        ''' Queues a conversion, blocking while the queue is full, and returns its Future '''
+        self.slots.acquire()
+        try:
+            return self.executor.submit(self._convert, html, format, outputfile)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def convert(self, html, format, outputfile):
+        return self.submit(html, format, outputfile).result()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    ''' The conversion pool of this process, created on first use '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            config = current_app.config
+            _pool = ConversionPool(workers=config['PANDOC_WORKERS'] or os.cpu_count() or 1,
+                                   queue_size=config['PANDOC_QUEUE_SIZE'], timeout=config['PANDOC_TIMEOUT'],
+                                   memory_limit_mb=config['PANDOC_MEMORY_LIMIT_MB'])
+        return _pool
+
+
+def convert_html(html, format, outputfile):
+    return get_pool().convert(html, format, outputfile)
@@ -1,119 +1,230 @@
 # import things
+import glob
+import hashlib
+import io
 import os
+import tempfile
+import zipfile
+from concurrent.futures import wait, FIRST_COMPLETED
 
+from flask import current_app
 from flask_table import create_table, Col, Table
 
-from app.main.forms import DISSEMINATION_LEVELS, DELIVERABLE_TYPES
-from app.models import Proposal, Company
+from app.models import Company, ProposalGraph, DISSEMINATION_LEVELS, DELIVERABLE_TYPES
+from app.custom_libs.cache_lib import get_version_key
+from app.custom_libs.pandoc_lib import EXPORT_FORMATS, get_pool
 from app.custom_libs.tables_lib import get_WP_table, get_WPeffort_table, get_participants_table
 from app.custom_libs.utilities_lib import create_folder
 
 
 class ProposalText:
+    ''' Proposal document built from the compiled export/ section templates.
+    iter_html() yields the document in chunks, to_html() joins them in a single buffer '''
+    template = 'export/proposal.html'
+
     def __init__(self, proposal):
         self.proposal = proposal
-        self.folder = create_folder(self.proposal.acronym)
-
-    def define_path(self, filename):
-        return os.path.join(self.folder, filename)
-
-    def general_info(self):
-        return f""" {to_hx('General Information', 1)}\n
-{wrap_with(wrap_with('Call: ', 'b') + self.proposal.call, 'p')}\n
-{wrap_with(wrap_with('Acronym: ', 'b') + self.proposal.acronym, 'p')}\n
-{wrap_with(wrap_with('Title: ', 'b') + self.proposal.title, 'p')}\n
-{wrap_with(wrap_with('Duration in months: ', 'b') + str(self.proposal.duration_months), 'p')}\n
-{wrap_with(wrap_with('Abstract: ', 'b') + self.proposal.description, 'p')}"""
-
-    def participants(self):
-        table = get_participants_table(self.proposal.acronym)
-        return f""" {to_hx('Participants', 1)}\n{table.__html__()}"""
-
-    def budget(self):
-        table = get_printable_budget_table(self.proposal.acronym)
-        return f""" {to_hx('Budget', 1)}\n{wrap_with('All the costs are in kEUR', 'p')}\n{table.__html__()}"""
-
-    def wp_list(self):
-        table = get_WP_table(self.proposal.acronym)
-        return f""" {to_hx('Working Packages List', 1)}\n{table.__html__()}"""
-
-    def efforts(self):
-        table = get_WPeffort_table(self.proposal.acronym)
-        return f""" {to_hx('Effort per WP', 1)}\n{table.__html__()}"""
-
-    def deliverables(self):
-        table = get_printable_deliverable_table(self.proposal.acronym)
-        return f""" {to_hx('Deliverables', 1)}\n{table.__html__()}"""
-
-    def write_description(self):
-        with open(f'{self.define_path(self.proposal.acronym)}.html', 'w+') as file:
-            file.write(self.general_info())
-            file.write(self.participants())
-            file.write(self.budget())
-            file.write(self.wp_list())
-            file.write(self.efforts())
-            file.write(self.deliverables())
-
-            for wp in self.proposal.working_packages:
-                file.write(to_hx(f'WP{wp.number} - {wp.title}', 2))
-                file.write(wp_summary(wp))
-                file.write(wrap_with(f"{wrap_with('Description:', 'b')} {wp.description}", 'p'))
-                file.write(
-                    wrap_with(f"{wrap_with('Deliverables:', 'b')} {get_printable_wp_deliverable_table(wp).__html__()}",
-                              'p'))
-                for deliverable in wp.deliverables:
-                    file.write(wp_deliverables(deliverable))
-
-        return f'{self.define_path(self.proposal.acronym)}.html'
-
-
-def to_hx(text, level):
-    return f"<h{level}> {text} </h{level}>\n"
-
-
-def wrap_with(text, tag='div'):
-    return f"<{tag}> {text} </{tag}>\n"
-
-
-def wp_summary(wp):
-    str1 = wrap_with(
-        f"{wrap_with('Start Month:', 'b')} {wp.start_month} - {wrap_with('End Month:', 'b')} {wp.end_month}", 'p')
-    if wp.get_leader_acronym():
-        str2 = wrap_with(f"{wrap_with('Lead Beneficiary:', 'b')} {Company.get_company_acronym(wp.get_leader_acronym()).name}", 'p')
-    else:
-        str2 = wrap_with(
-            f"{wrap_with('Lead Beneficiary:', 'b')} Not Assigned", 'p')
-    tab = get_wp_effort_summary_table(wp)
-    str3 = wrap_with(tab.__html__(), 'div')
-    return str1 + str2 + str3
-
-
-def wp_deliverables(deliverable):
-    str = to_hx(f'D{deliverable.ref_wp.number}.{deliverable.number} - {deliverable.title}', 3)
-    str1 = wrap_with(f"{wrap_with('Due Month:', 'b')} {deliverable.due_month}", 'p')
-    str2 = wrap_with(f"{wrap_with('Responsible:', 'b')} {Company.get_company_acronym(deliverable.responsible).name}", 'p')
-    type = [item[1] for item in DELIVERABLE_TYPES if item[0] == deliverable.type][0]
-    str3 = wrap_with(f"{wrap_with('Type:', 'b')} {type}", 'p')
-    diss_lev = [item[1] for item in DISSEMINATION_LEVELS if item[0] == deliverable.dissemination_level][0]
-    str4 = wrap_with(f"{wrap_with('Dissemination Level:', 'b')} {diss_lev}", 'p')
-    str5 = wrap_with(f"{wrap_with('Description:', 'b')} {deliverable.description}", 'p')
-    return str + str1 + str2 + str3 + str4 + str5
+        self.graph = ProposalGraph(proposal)
+
+    def company_name(self, acronym):
+        company = Company.get_company_acronym(acronym)
+        return company.name if company else acronym
+
+    def context(self):
+        return dict(proposal=self.proposal, graph=self.graph,
+                    participants_table=get_participants_table(self.graph),
+                    budget_table=get_printable_budget_table(self.graph),
+                    wp_table=get_WP_table(self.graph, links=False),
+                    effort_table=get_WPeffort_table(self.graph, links=False),
+                    deliverables_table=get_printable_deliverable_table(self.graph),
+                    wp_effort_table=lambda wp: get_wp_effort_summary_table(wp, self.graph),
+                    wp_deliverable_table=lambda wp: get_printable_wp_deliverable_table(wp, self.graph),
+                    company_name=self.company_name,
+                    deliverable_types=dict(DELIVERABLE_TYPES),
+                    dissemination_levels=dict(DISSEMINATION_LEVELS))
+
+    def iter_html(self):
+        return current_app.jinja_env.get_template(self.template).generate(**self.context())
+
+    def to_html(self):
+        return ''.join(self.iter_html())
+
+
+# Exported artifacts are stored under a hash of (proposal version, format, EXPORT_TEMPLATE_VERSION) in the
+# EXPORTS_FOLDER of each proposal, and evicted least recently used first above EXPORT_CACHE_MAX_BYTES.
+# Bump EXPORT_TEMPLATE_VERSION whenever the ProposalText output changes.
+EXPORT_TEMPLATE_VERSION = 3
+EXPORTS_FOLDER = 'exports'
+
+
+def get_export_path(proposal, format):
+    key = hashlib.sha256(f'{get_version_key(proposal)}:{format}:{EXPORT_TEMPLATE_VERSION}'.encode('utf-8'))
+    folder = create_folder(os.path.join(proposal.acronym, EXPORTS_FOLDER))
+    return os.path.join(folder, f'{key.hexdigest()}.{format}')
+
+
+def get_cached_export(proposal, format):
+    ''' Path of the already exported artifact of the current proposal version, or None '''
+    path = get_export_path(proposal, format)
+    if not os.path.exists(path):
+        return None
+    os.utime(path)
+    return path
+
+
+def submit_export(proposal, format):
+    ''' Renders the proposal and queues its conversion on the pandoc pool, to a unique temporary file.
+    Returns the export path and the conversion Future, which is None when the export is already cached '''
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f'Unsupported export format: {format}')
+    path = get_cached_export(proposal, format)
+    if path:
+        return path, None
+    path = get_export_path(proposal, format)
+    html = ProposalText(proposal).to_html()
+    # hidden, so evict_exports doesn't glob the conversions in progress
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.export-', suffix=f'.{format}')
+    os.close(fd)
+    try:
+        return path, get_pool().submit(html, format, temp)
+    except Exception:
+        os.remove(temp)
+        raise
+
+
+def complete_export(path, future):
+    ''' Waits for a conversion started by submit_export and moves the artifact in place.
+    The pool removes the temporary file of a failed conversion '''
+    if future is not None:
+        os.replace(future.result(), path)
+    return path
+
+
+def export_proposal_file(proposal, format, progress=None):
+    ''' Converts the proposal to the given pandoc format, unless already exported, and returns the file path '''
+    path, future = submit_export(proposal, format)
+    if future is None:
+        return path
+    if progress:
+        progress(50)
+    complete_export(path, future)
+    evict_exports(current_app.config['EXPORT_CACHE_MAX_BYTES'])
+    return path
+
+
+def evict_exports(max_bytes):
+    ''' Removes the least recently used exports of all the proposals until they fit in max_bytes '''
+    main_route = os.path.join(current_app.root_path, current_app.config['DOWNLOAD_FOLDER'])
+    files = []
+    for path in glob.glob(os.path.join(main_route, '*', EXPORTS_FOLDER, '*')):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(x[1] for x in files)
+    for mtime, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+# --------------- Bulk export ------------------------#
+# The archive is written by zipfile to an unseekable buffer that is drained after every chunk, so entries
+# are streamed (with data descriptors) as soon as each conversion completes and the whole archive is never
+# held in memory. Only the conversions run in parallel on the pandoc pool: the proposals are rendered to html
+# one at a time in the calling thread, which needs the app context and the db session of the request.
+
+ZIP_CHUNK_SIZE = 64 * 1024
+
+
+class ZipStream(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _zip_entry(archive, stream, arcname, path):
+    with archive.open(arcname, 'w') as entry, open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(ZIP_CHUNK_SIZE), b''):
+            entry.write(chunk)
+            yield stream.drain()
+    yield stream.drain()
+
+
+def _zip_error(archive, stream, arcname, error):
+    archive.writestr(arcname, str(error))
+    yield stream.drain()
+
+
+def iter_bulk_export(proposals, format):
+    ''' Yields a ZIP archive with the export of every proposal, one entry per proposal in completion order.
+    A failed conversion is logged and replaced in the archive by an <acronym>.error.txt entry.
+    The html of the next proposal is rendered while the previous ones convert '''
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED)
+    pending = {}
+
+    def entries(futures):
+        for future in futures:
+            acronym, path = pending.pop(future)
+            try:
+                complete_export(path, future)
+            except Exception as e:
+                current_app.logger.error(f'Bulk export of {acronym} to {format} failed', exc_info=True)
+                yield from _zip_error(archive, stream, f'{acronym}.error.txt', e)
+            else:
+                yield from _zip_entry(archive, stream, f'{acronym}.{format}', path)
+
+    for proposal in proposals:
+        try:
+            path, future = submit_export(proposal, format)
+        except Exception as e:
+            current_app.logger.error(f'Bulk export of {proposal.acronym} to {format} failed', exc_info=True)
+            yield from _zip_error(archive, stream, f'{proposal.acronym}.error.txt', e)
+            continue
+        if future is None:
+            yield from _zip_entry(archive, stream, f'{proposal.acronym}.{format}', path)
+            continue
+        pending[future] = (proposal.acronym, path)
+        yield from entries([x for x in list(pending) if x.done()])
+    while pending:
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        yield from entries(done)
+    archive.close()
+    yield stream.drain()
+    evict_exports(current_app.config['EXPORT_CACHE_MAX_BYTES'])
 
 
 # Printable Tables
 
-def get_wp_effort_summary_table(wp):
+def get_wp_effort_summary_table(wp, graph):
     TableCls = create_table('TableCls').add_column('wp', Col(''))
-    proposal = wp.ref_proposal
+    proposal = graph.proposal
 
-    for company in proposal.participants:
+    for company in graph.companies:
         TableCls.add_column(f'{company.acronym}', Col(f'{company.acronym}'))
 
     TableCls.add_column('sum_wp', Col('Total'))
 
     items = []
 
-    d = {company.acronym: None for company in proposal.participants}
+    d = {company.acronym: None for company in graph.companies}
     d["wp"] = f"WP{wp.number}"
     d["proposal_acronym"] = proposal.acronym
     d["wp_number"] = wp.number
@@ -139,21 +250,8 @@ class BudgetTablePrintable(Table):
     table_id = 'budget_table'
 
 
-def get_printable_budget_table(proposal_acronym):
-    proposal = Proposal.get_proposal_acronym(proposal_acronym)
-    items = []
-    indirect_costs_rate = proposal.indirect_costs_rate
-    for element in proposal.proposal_participant:
-        indirect_costs = (element.personnel_cost + element.other_direct_costs) * indirect_costs_rate
-        total_costs = element.personnel_cost + element.other_direct_costs + indirect_costs + element.subcontracting_cost
-        reimbursement_rate_percent = proposal.get_reimbursement_rate(element.company)
-        items.append(dict(participant=element.company.acronym, country=element.company.country,
-                          personnel_costs=element.personnel_cost,
-                          other_direct_costs=element.other_direct_costs,
-                          subcontracting_costs=element.subcontracting_cost,
-                          indirect_costs=indirect_costs, total_costs=total_costs,
-                          reimbursement_rate=reimbursement_rate_percent,
-                          contribution=total_costs * reimbursement_rate_percent / 100))
+def get_printable_budget_table(graph):
+    items = graph.proposal.get_budget(graph.participants).rows()
     return BudgetTablePrintable(items)
 
 
@@ -167,11 +265,11 @@ class DeliverableTablePrintable(Table):
     table_id = 'deliverable_table'
 
 
-def get_printable_deliverable_table(proposal_acronym):
-    proposal = Proposal.get_proposal_acronym(proposal_acronym)
+def get_printable_deliverable_table(graph):
+    proposal = graph.proposal
     items = []
-    for wp in proposal.working_packages:
-        for deliverable in wp.deliverables:
+    for wp in graph.working_packages:
+        for deliverable in graph.get_deliverables(wp):
             items.append(dict(proposal_acronym=proposal.acronym, wp_number=wp.number,
                               responsible=deliverable.responsible, title=deliverable.title,
                               description=deliverable.description, due_month=deliverable.due_month,
@@ -181,10 +279,10 @@ def get_printable_deliverable_table(proposal_acronym):
     return DeliverableTablePrintable(items)
 
 
-def get_printable_wp_deliverable_table(wp_object):
-    proposal = wp_object.ref_proposal
+def get_printable_wp_deliverable_table(wp_object, graph):
+    proposal = graph.proposal
     items = []
-    for deliverable in wp_object.deliverables:
+    for deliverable in graph.get_deliverables(wp_object):
         items.append(dict(proposal_acronym=proposal.acronym, wp_number=wp_object.number,
                           responsible=deliverable.responsible, title=deliverable.title,
                           description=deliverable.description, due_month=deliverable.due_month,
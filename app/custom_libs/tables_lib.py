@@ -3,7 +3,6 @@ import re
 
 from flask_table import Table, Col, LinkCol, create_table, BoolCol
 
-from app.models import Proposal
 
 # Declare your table
 
@@ -21,15 +20,20 @@ class WPTable(Table):
     classes = ['display']
 
 
-def get_WP_table(proposal_acronym):
-    proposal = Proposal.get_proposal_acronym(proposal_acronym)
+class PrintableWPTable(WPTable):
+    title = Col('Title')
+
+
+def get_WP_table(graph, links=True):
+    ''' links=False renders plain titles, as the dashboard links need a request context for url_for '''
+    proposal = graph.proposal
     items = []
-    for wp in proposal.working_packages:
+    for wp in graph.working_packages:
         items.append(dict(number=wp.number, title=wp.title, lead_participant=wp.get_leader_acronym(),
                           person_month=wp.get_total_effort(), start_month=wp.start_month,
                           end_month=wp.end_month, proposal=proposal, wp=wp))
 
-    return WPTable(items)
+    return WPTable(items) if links else PrintableWPTable(items)
 
 
 class BudgetTable(Table):
@@ -48,43 +52,31 @@ class BudgetTable(Table):
     # html_attrs = {'style':"width: 100%;", 'border':"1"}
 
 
-def get_budget_table(proposal_acronym):
-    proposal = Proposal.get_proposal_acronym(proposal_acronym)
-    items = []
-    indirect_costs_rate = proposal.indirect_costs_rate
-    for element in proposal.proposal_participant:
-        reimbursement_rate_percent = proposal.get_reimbursement_rate(element.company)
-        indirect_costs = (element.personnel_cost + element.other_direct_costs) * indirect_costs_rate
-        total_costs = element.personnel_cost + element.other_direct_costs + indirect_costs + element.subcontracting_cost
-        items.append(dict(participant_number=element.participant_number, participant=element.company.acronym,
-                          country=element.company.country, personnel_costs=element.personnel_cost,
-                          other_direct_costs=element.other_direct_costs,
-                          subcontracting_costs=element.subcontracting_cost,
-                          indirect_costs=indirect_costs, total_costs=total_costs,
-                          reimbursement_rate=reimbursement_rate_percent,
-                          contribution=total_costs * reimbursement_rate_percent / 100))
+def get_budget_table(graph):
+    items = graph.proposal.get_budget(graph.participants).rows()
     return BudgetTable(items)
 
 
-def get_WPeffort_table(proposal_acronym):
-    proposal = Proposal.get_proposal_acronym(proposal_acronym)
+def get_WPeffort_table(graph, links=True):
+    proposal = graph.proposal
 
     tbl_options = dict(table_id='wp_effort_table', classes=['display'])
 
-    TableCls = create_table('TableCls', options=tbl_options).add_column('wp', LinkCol('WP no.', 'main.wp_dashboard',
-                                                                                      url_kwargs=dict(
-                                                                                          proposal_acronym='proposal_acronym',
-                                                                                          wp_number='wp_number'),
-                                                                                      attr='wp'))
+    if links:
+        wp_col = LinkCol('WP no.', 'main.wp_dashboard',
+                         url_kwargs=dict(proposal_acronym='proposal_acronym', wp_number='wp_number'), attr='wp')
+    else:
+        wp_col = Col('WP no.')
+    TableCls = create_table('TableCls', options=tbl_options).add_column('wp', wp_col)
 
-    for company in proposal.participants:
+    for company in graph.companies:
         TableCls.add_column(f'{company.acronym}', Col(f'{company.acronym}'))
 
     TableCls.add_column('sum_wp', Col('Total'))
 
     items = []
-    for wp in proposal.working_packages:
-        d = {company.acronym: None for company in proposal.participants}
+    for wp in graph.working_packages:
+        d = {company.acronym: None for company in graph.companies}
         d["wp"] = wp.number
         d["proposal_acronym"] = proposal.acronym
         d["wp_number"] = wp.number
@@ -128,11 +120,11 @@ def get_wp_deliverable_table(wp_object):
     return DeliverableTable(items)
 
 
-def get_proposal_deliverable_table(proposal_acronym):
-    proposal = Proposal.get_proposal_acronym(proposal_acronym)
+def get_proposal_deliverable_table(graph):
+    proposal = graph.proposal
     items = []
-    for wp in proposal.working_packages:
-        for deliverable in wp.deliverables:
+    for wp in graph.working_packages:
+        for deliverable in graph.get_deliverables(wp):
             items.append(dict(proposal_acronym=proposal.acronym, wp_number=wp.number,
                               responsible=deliverable.responsible, title=deliverable.title,
                               description=deliverable.description, due_month=deliverable.due_month,
@@ -168,11 +160,11 @@ def get_wp_milestone_table(wp_object):
     return MilestoneTable(items)
 
 
-def get_proposal_milestone_table(proposal_acronym):
-    proposal = Proposal.get_proposal_acronym(proposal_acronym)
+def get_proposal_milestone_table(graph):
+    proposal = graph.proposal
     items = []
-    for wp in proposal.working_packages:
-        for milestone in wp.milestones:
+    for wp in graph.working_packages:
+        for milestone in graph.get_milestones(wp):
             items.append(dict(proposal_acronym=proposal.acronym, wp_number=wp.number,
                               responsible=milestone.responsible, title=milestone.title,
                               description=milestone.description, due_month=milestone.due_month,
@@ -189,10 +181,9 @@ class ParticipantsTable(Table):
     classes = ['display']
 
 
-def get_participants_table(proposal_acronym):
-    proposal = Proposal.get_proposal_acronym(proposal_acronym)
+def get_participants_table(graph):
     items = []
-    for element in proposal.proposal_participant:
+    for element in graph.participants:
         items.append(dict(acronym=element.company.acronym, country=element.company.country,
                           name=element.company.name, role=element.is_coordinator))
     return ParticipantsTable(items)
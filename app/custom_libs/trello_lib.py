@@ -1,5 +1,18 @@
-from dateutil.relativedelta import relativedelta
+import hashlib
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from flask import current_app
+from redis.exceptions import RedisError
 from trello import TrelloClient
+from trello.exceptions import ResourceUnavailable
+
+from app import db
+from app.models import ProposalGraph, TrelloCard
 
 
 # client = TrelloClient(
@@ -19,8 +32,114 @@ from trello import TrelloClient
 # ['add_checklist', 'add_label', 'add_member', 'assign', 'attach', 'attachments', 'attriExp', 'badges', 'board', 'board_id', 'card_created_date', 'change_board', 'change_list', 'change_pos', 'checklists', 'client', 'closed', 'comment', 'comments', 'countCheckItems', 'create_label', 'created_date', 'customFields', 'custom_fields', 'dateLastActivity', 'date_last_activity', 'delete', 'delete_comment', 'desc', 'description', 'due', 'due_date', 'fetch', 'fetch_actions', 'fetch_attachments', 'fetch_checklists', 'fetch_comments', 'fetch_custom_fields', 'fetch_plugin_data', 'from_json', 'get_attachments', 'get_comments', 'get_custom_field_by_name', 'get_list', 'get_stats_by_list', 'id', 'idBoard', 'idLabels', 'idList', 'idMembers', 'idShort', 'is_due_complete', 'labels', 'latestCardMove_date', 'listCardMove_date', 'list_id', 'list_movements', 'member_id', 'member_ids', 'name', 'plugin_data', 'pos', 'remove_attachment', 'remove_due', 'remove_due_complete', 'remove_label', 'remove_member', 'set_closed', 'set_custom_field', 'set_description', 'set_due', 'set_due_complete', 'set_name', 'set_pos', 'shortUrl', 'short_id', 'short_url', 'subscribe', 'trello_list', 'unassign', 'update_comment', 'url']
 
 
-def get_board_byname(client, board_name):
-    ''' Case insensitive search. Returns last matched board object or creates a new one '''
+# --------------- Rate limited client ------------------------#
+# Trello allows 100 requests every 10 seconds per token: the requests of a token are spaced by a limiter
+# whose schedule is kept in Redis, so it is shared by the worker threads and by the concurrent sync jobs of
+# every RQ worker (it falls back to a per process schedule when Redis is unavailable). Rate limited (429)
+# requests are delayed by their Retry-After for every client of the token; failed (5xx) requests and
+# connection errors are retried with an exponential backoff. Read timeouts are only retried for GET, as the
+# other requests may already have been applied.
+
+RATE_LIMIT_WINDOW = 10
+RETRY_BASE_DELAY = 1
+RATE_LIMIT_PREFIX = 'trello:ratelimit'
+
+# Reserves the next slot of the token (not before ARGV[3]) and returns how long to wait for it
+RESERVE_SLOT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local slot = math.max(tonumber(redis.call('GET', KEYS[1]) or 0), now, tonumber(ARGV[3]))
+redis.call('SET', KEYS[1], tostring(slot + tonumber(ARGV[2])), 'EX', ARGV[4])
+return tostring(slot - now)
+"""
+
+
+class RateLimiter:
+    def __init__(self, token, requests, window=RATE_LIMIT_WINDOW, redis=None):
+        self.key = f'{RATE_LIMIT_PREFIX}:{hashlib.sha1(token.encode("utf-8")).hexdigest()}'
+        self.interval = window / requests
+        self.window = window
+        self.script = redis.register_script(RESERVE_SLOT_SCRIPT) if redis is not None else None
+        self.logger = current_app.logger
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def _reserve(self, now, not_before):
+        if self.script is not None:
+            try:
+                return float(self.script(keys=[self.key], args=[now, self.interval, not_before,
+                                                                int(max(not_before - now, 0) + self.window)]))
+            except RedisError:
+                self.logger.warning('Trello rate limit shared in this process only', exc_info=True)
+                self.script = None
+        with self.lock:
+            slot = max(self.next_slot, now, not_before)
+            self.next_slot = slot + self.interval
+        return slot - now
+
+    def wait(self, not_before=0):
+        ''' Blocks until the next request of the token is allowed, and not before the not_before timestamp '''
+        delay = self._reserve(time.time(), not_before)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def retry_after(response):
+    ''' Seconds of the Retry-After header of the response, or None '''
+    try:
+        return max(float(response.headers['Retry-After']), 0)
+    except (KeyError, ValueError):
+        return None
+
+
+class RateLimitedService:
+    ''' http_service of the Trello client, sending the requests through the limiter and retrying them '''
+
+    def __init__(self, limiter, retries):
+        self.limiter = limiter
+        self.retries = retries
+
+    def _retryable(self, method, error):
+        return isinstance(error, requests.exceptions.ConnectionError) or (
+                method == 'GET' and isinstance(error, requests.exceptions.Timeout))
+
+    def request(self, method, url, **kwargs):
+        not_before = 0
+        for attempt in range(self.retries + 1):
+            self.limiter.wait(not_before)
+            backoff = RETRY_BASE_DELAY * 2 ** attempt + random.random()
+            try:
+                response = requests.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                if attempt == self.retries or not self._retryable(method, e):
+                    raise
+                time.sleep(backoff)
+                continue
+            if attempt == self.retries or (response.status_code != 429 and response.status_code < 500):
+                return response
+            if response.status_code == 429:
+                delay = retry_after(response)
+                not_before = time.time() + (backoff if delay is None else delay)
+            else:
+                time.sleep(backoff)
+
+
+class RateLimitedClient(TrelloClient):
+    def __init__(self, *args, rate_limit, retries, redis=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        limiter = RateLimiter(self.resource_owner_key or self.api_secret or self.api_key, rate_limit, redis=redis)
+        self.http_service = RateLimitedService(limiter, retries)
+
+
+def get_board_byname(client, board_name, board_ids=()):
+    ''' Case insensitive search. Returns the first known board (by id) with a matching name, otherwise the
+    last matched board object or creates a new one '''
+    for board_id in board_ids:
+        try:
+            board = client.get_board(board_id)
+        except ResourceUnavailable:
+            continue
+        if not board.closed and board_name.lower() in board.name.lower():
+            return board
     all_boards = client.list_boards()
     result = [x for x in all_boards if board_name.lower() in x.name.lower()]
     if result:
@@ -29,32 +148,44 @@ def get_board_byname(client, board_name):
         return client.add_board(board_name)
 
 
-def clean_board(board):
-    [x.delete() for x in board.get_cards()]
-    return board
-
+class BoardIndex:
+    ''' Lists, labels and open cards of a board, fetched once per sync and indexed by id and by list, so every
+    lookup is resolved in memory instead of listing the cards of a list again '''
 
-def get_list_byname(board, list_name):
-    ''' Case insensitive search. Returns last matched list object or creates a new one '''
-    result = [x for x in board.all_lists() if list_name.lower() in x.name.lower()]
-    if result:
-        return result[-1]
-    else:
-        return board.add_list(list_name)
+    def __init__(self, board):
+        self.board = board
+        self.lists = board.all_lists()
+        self.labels = board.get_labels()
+        self.cards = {}
+        self.list_cards = {x.id: [] for x in self.lists}
+        for card in board.open_cards():
+            self._add_card(card.idList, card)
 
+    def _add_card(self, list_id, card):
+        self.cards[card.id] = card
+        self.list_cards.setdefault(list_id, []).append(card)
 
-def clean_list(list):
-    [x.delete() for x in list.list_cards()]
-    return list
+    def has_card(self, card_id):
+        return card_id in self.cards
 
+    def get_list(self, list_name):
+        ''' Case insensitive search. Returns last matched list object or creates a new one '''
+        result = [x for x in self.lists if list_name.lower() in x.name.lower()]
+        if result:
+            return result[-1]
+        card_list = self.board.add_list(list_name)
+        self.lists.append(card_list)
+        self.list_cards[card_list.id] = []
+        return card_list
 
-def get_card_byname(card_list, card_name):
-    ''' Case insensitive search. Returns last matched card object or creates a new one '''
-    result = [x for x in card_list.list_cards() if card_name.lower() in x.name.lower()]
-    if result:
-        return result[-1]
-    else:
-        return card_list.add_card(card_name)
+    def get_card(self, card_list, card_name):
+        ''' Case insensitive search. Returns last matched card object or creates a new one '''
+        result = [x for x in self.list_cards.get(card_list.id, []) if card_name.lower() in x.name.lower()]
+        if result:
+            return result[-1]
+        card = card_list.add_card(card_name)
+        self._add_card(card_list.id, card)
+        return card
 
 
 def secure_set_description(card, description):
@@ -85,52 +216,150 @@ def mil_card_text(milestone):
     return title, description
 
 
-def execute_send_trello(app, proposal, user):
-    with app.app_context():
-        send_proposal_to_trello(proposal=proposal, user=user)
+# --------------- Incremental sync ------------------------#
+# The cards created for WPs, deliverables and milestones are recorded in TrelloCard with the hash of their
+# content, so a sync only creates, updates or archives the cards whose data changed and keeps the history
+# (comments, checklists, members) of the others.
+# The proposal is snapshotted before the first Trello request. The requests then run on a bounded thread
+# pool, while the mapping is only written from the calling thread as they complete. A failed card is reported
+# and does not stop the sync.
+
+ITEM_LISTS = {'wp': 'Work Packages', 'deliverable': 'Deliverables', 'milestone': 'Milestones'}
+
+
+def card_fields(title, description, due, label, card_list):
+    return {'name': title, 'desc': description, 'due': due.isoformat(), 'idLabels': label.id if label else '',
+            'idList': card_list.id}
+
+
+def content_hash(fields):
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def create_card(client, fields):
+    return client.fetch_json('/cards', http_method='POST', post_args=fields)['id']
+
+
+def update_card(client, card_id, fields):
+    client.fetch_json(f'/cards/{card_id}', http_method='PUT', post_args=dict(fields, closed='false'))
+
+
+def archive_card(client, card_id):
+    client.fetch_json(f'/cards/{card_id}/closed', http_method='PUT', post_args={'value': 'true'})
 
 
-def send_proposal_to_trello(proposal, user):
+def push_card(client, card_id, fields):
+    ''' Updates the card, or creates it when new or deleted on Trello. Returns the card id and the action '''
+    if card_id is not None:
+        try:
+            update_card(client, card_id, fields)
+            return card_id, 'updated'
+        except ResourceUnavailable as e:
+            if e._status != 404:
+                raise
+    return create_card(client, fields), 'created'
+
+
+def discard_card(client, card_id):
+    try:
+        archive_card(client, card_id)
+    except ResourceUnavailable as e:
+        if e._status != 404:
+            raise
+    return card_id, 'archived'
+
+
+def snapshot_proposal(proposal):
+    ''' Plain data of everything the sync sends to Trello, read from the database up front '''
+    graph = ProposalGraph(proposal)
+    months = proposal.get_calendar()
+    items = []
+    for index, work_package in enumerate(graph.working_packages):
+        items.append(('wp', work_package.id, index, *wp_card_text(work_package),
+                      months.date(work_package.end_month)))
+        for deliverable in graph.get_deliverables(work_package):
+            items.append(('deliverable', deliverable.id, index, *del_card_text(deliverable),
+                          months.date(deliverable.due_month)))
+        for milestone in graph.get_milestones(work_package):
+            items.append(('milestone', milestone.id, index, *mil_card_text(milestone),
+                          months.date(milestone.due_month)))
+    contacts = '\n'.join(
+        [f'{item.user.name} {item.user.surname.upper()} - {item.user.email}' for item in graph.memberships])
+    return dict(acronym=proposal.acronym, description=proposal.description, contacts=contacts, items=items,
+                board_ids=TrelloCard.get_board_ids('wp', [x.id for x in graph.working_packages]))
+
+
+def get_board_items(items, index, lists):
+    ''' (item_type, item_id, card fields) of every snapshotted WP, deliverable and milestone '''
+    labels = index.labels
+    for item_type, item_id, wp_index, title, description, due in items:
+        label = labels[wp_index] if wp_index < len(labels) else None
+        yield item_type, item_id, card_fields(title, description, due, label, lists[item_type])
+
+
+def sync_cards(client, index, items, executor, progress=None):
+    ''' Creates, updates or archives the board cards so they match the items, and returns the counts and the
+    failed cards. A mapped card archived on Trello is restored, a deleted one is recreated. The mapping is
+    committed even if the sync stops midway, so it always reflects the cards that exist. '''
+    board = index.board
+    mapping = TrelloCard.get_board_cards(board.id)
+    counts = dict(created=0, updated=0, archived=0)
+    failures = []
+    pending = {}
+    for item_type, item_id, fields in items:
+        digest = content_hash(fields)
+        card = mapping.pop((item_type, item_id), None)
+        if card is not None and card.content_hash == digest and index.has_card(card.card_id):
+            continue
+        future = executor.submit(push_card, client, card.card_id if card else None, fields)
+        pending[future] = (item_type, item_id, card, digest, fields['name'])
+    for card in mapping.values():
+        future = executor.submit(discard_card, client, card.card_id)
+        pending[future] = (card.item_type, card.item_id, card, None, f'Removed {card.item_type} {card.item_id}')
     try:
-        client = TrelloClient(api_key=user.trello_api_key, api_secret=user.trello_api_key, token=user.trello_token,
-                              token_secret=user.trello_token)
-        project_board = get_board_byname(client=client, board_name=proposal.acronym)
-        # Project List
-        list_name = 'Project'
-        project_list = get_list_byname(board=project_board, list_name=list_name)
-        abstract_card = get_card_byname(card_list=project_list, card_name='Abstract')
-        secure_set_description(card=abstract_card, description=proposal.description)
-        contacts_card = get_card_byname(card_list=project_list, card_name='Contacts List')
-        description = '\n'.join(
-            [f'{item.user.name} {item.user.surname.upper()} - {item.user.email}' for item in proposal.user_membership])
-        secure_set_description(card=contacts_card, description=description)
-
-        # WPs List
-        list = get_list_byname(board=project_board, list_name='Work Packages')
-        wps_list = clean_list(list=list)
-        list = get_list_byname(board=project_board, list_name='Deliverables')
-        del_list = clean_list(list=list)
-        list = get_list_byname(board=project_board, list_name='Milestones')
-        mil_list = clean_list(list=list)
-        for work_package, label in zip(proposal.working_packages, project_board.get_labels()):
-            title, description = wp_card_text(work_package)
-            wpcard = get_card_byname(card_list=wps_list, card_name=title)
-            secure_set_description(card=wpcard, description=description)
-            wpcard.set_due(proposal.start_date + relativedelta(months=work_package.end_month))
-            wpcard.add_label(label)
-            for deliverable in work_package.deliverables:
-                title, description = del_card_text(deliverable)
-                del_card = get_card_byname(card_list=del_list, card_name=title)
-                secure_set_description(card=del_card, description=description)
-                del_card.set_due(proposal.start_date + relativedelta(months=deliverable.due_month))
-                del_card.add_label(label)
-
-            for milestone in work_package.milestones:
-                title, description = mil_card_text(milestone)
-                mil_card = get_card_byname(card_list=mil_list, card_name=title)
-                secure_set_description(card=mil_card, description=description)
-                mil_card.set_due(proposal.start_date + relativedelta(months=milestone.due_month))
-                mil_card.add_label(label)
-        return 'Proposal correctly submitted to your Trello account'
-    except Exception as e:
-        return e
+        for done, future in enumerate(as_completed(pending), 1):
+            item_type, item_id, card, digest, name = pending[future]
+            try:
+                card_id, action = future.result()
+            except Exception as e:
+                failures.append(dict(card=name, error=str(e)))
+                continue
+            counts[action] += 1
+            if action == 'archived':
+                db.session.delete(card)
+            elif card is None:
+                db.session.add(TrelloCard(board_id=board.id, item_type=item_type, item_id=item_id, card_id=card_id,
+                                          content_hash=digest))
+            else:
+                card.card_id = card_id
+                card.content_hash = digest
+            if progress:
+                progress(done, len(pending))
+    finally:
+        db.session.commit()
+    return counts, failures
+
+
+def send_proposal_to_trello(proposal, user, progress=None):
+    ''' Syncs the proposal to the user's Trello board and returns the card counts and the failed cards '''
+    snapshot = snapshot_proposal(proposal)
+    config = current_app.config
+    client = RateLimitedClient(api_key=user.trello_api_key, api_secret=user.trello_api_key, token=user.trello_token,
+                               token_secret=user.trello_token, rate_limit=config['TRELLO_RATE_LIMIT'],
+                               retries=config['TRELLO_RETRIES'], redis=current_app.redis)
+    project_board = get_board_byname(client=client, board_name=snapshot['acronym'], board_ids=snapshot['board_ids'])
+    index = BoardIndex(project_board)
+    # Project List
+    list_name = 'Project'
+    project_list = index.get_list(list_name=list_name)
+    abstract_card = index.get_card(card_list=project_list, card_name='Abstract')
+    secure_set_description(card=abstract_card, description=snapshot['description'])
+    contacts_card = index.get_card(card_list=project_list, card_name='Contacts List')
+    secure_set_description(card=contacts_card, description=snapshot['contacts'])
+
+    # WPs, Deliverables and Milestones Lists
+    lists = {key: index.get_list(list_name=name) for key, name in ITEM_LISTS.items()}
+    with ThreadPoolExecutor(max_workers=config['TRELLO_WORKERS'], thread_name_prefix='trello') as executor:
+        counts, failures = sync_cards(client, index, get_board_items(snapshot['items'], index, lists), executor,
+                                      progress=progress)
+    return dict(counts, failures=failures)
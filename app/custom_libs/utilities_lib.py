@@ -1,9 +1,10 @@
 from datetime import datetime
 import difflib
 import functools
+import hashlib
 import os
 
-from flask import url_for, redirect, current_app, abort, request, flash
+from flask import url_for, redirect, current_app, abort, request, flash, make_response, session, g
 from flask_admin.contrib import sqla
 from flask_login import current_user
 
@@ -46,11 +47,13 @@ def role_required(required_role):
         @functools.wraps(f)
         def decorated_function(*args, **kwargs):
             if 'proposal_acronym' in kwargs:
-                assigned_role = current_user.proposal_role(kwargs['proposal_acronym'])
                 if current_user.is_superuser():
                     return f(*args, **kwargs)
-                elif assigned_role is not None:
-                    if assigned_role >= ROLES[required_role]:
+                access = current_user.get_access_map().get(kwargs['proposal_acronym'])
+                if access is not None:
+                    if access[1] >= ROLES[required_role]:
+                        # the view's Proposal.get_proposal_acronym reuses the resolved id
+                        g.setdefault('proposal_ids', {})[kwargs['proposal_acronym']] = access[0]
                         return f(*args, **kwargs)
                     else:
                         flash("You do not have access to that page. Sorry!")
@@ -80,7 +83,6 @@ def requires_access_level(access_level):
     return decorator
 
 
-@try_except_decorator
 def add_admin_user():
     user = User.query.filter_by(username='admin').first()
     if not user:
@@ -93,14 +95,25 @@ def add_admin_user():
 STATUS = ['Draft', 'Completed', 'Sent', 'Accepted', 'Rejected']
 
 
-@try_except_decorator
 def add_proposal_statuses():
+    existing = [x for x, _ in ProposalStatus.get_statuses()]
     for st in STATUS:
-        status = ProposalStatus.query.filter_by(status=st).first()
-        if not status:
-            status = ProposalStatus(status=st, badge_type="info")
-            db.session.add(status)
-            db.session.commit()
+        if st not in existing:
+            db.session.add(ProposalStatus(status=st, badge_type="info"))
+    db.session.commit()
+
+
+def seed_database():
+    ''' Idempotent bootstrap of the admin user and of the proposal statuses.
+    Returns False when the database is not ready yet (e.g. before the first migration) '''
+    try:
+        add_admin_user()
+        add_proposal_statuses()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.warning(f'Database seeding skipped: {e}')
+        return False
 
 
 # --------------- ModelView functions ------------------------#
@@ -150,6 +163,21 @@ def color_diff(change):
             yield line
 
 
+# HTTP Utilities
+
+def conditional_response(etag_parts, render):
+    ''' Strong ETag built from etag_parts: answers 304 without calling render() when the client copy is current '''
+    etag = hashlib.sha1(':'.join(str(x) for x in etag_parts).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag) and not session.get('_flashes'):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
 # Files Utilities
 
 def create_folder(name):
@@ -10,24 +10,13 @@ from wtforms.validators import DataRequired, NumberRange, Email, ValidationError
 from wtforms_alchemy import model_form_factory
 
 from app import db
-from app.models import ProposalStatus, Company, date_format, ROLES, User, User_Proposal
+from app.models import ProposalStatus, Company, date_format, ROLES, User, User_Proposal, \
+    DISSEMINATION_LEVELS, DELIVERABLE_TYPES
 
 from country_list import countries_for_language
 
 BaseModelForm = model_form_factory(FlaskForm)
 
-DISSEMINATION_LEVELS = [('PU', 'Public'), ('PP', 'Restricted to other programme participants'),
-                        ('RE', 'Restricted to a group specified by the consortium'),
-                        ('CO', 'Confidential, only for members of the consortium'),
-                        ('CL restraint UE', 'Classified with the mention of the classification level RESTREINT UE'),
-                        ('CL confidential UE',
-                         'Classified with the mention of the classification level CONFIDENTIEL UE'),
-                        ('CL secret UE', 'Classified with the mention of the classification level SECRET UE')]
-
-DELIVERABLE_TYPES = [('R', 'Document, Report'), ('DEM', 'Demonstrator, Pilot, Prototype, Plan designs'),
-                     ('DEC', 'Websites, Patents filing, Press and media actions, Videos, etc.'),
-                     ('OTHER', 'Software, Technical diagram, etc.')]
-
 COMPANY_TYPES = [('RTO', 'Research and Technology Organization'), ('SME', 'Micro, Small and Medium-sized Enterprises'),
                  ('Large', 'Large Company'), ('University', 'University')]
 
@@ -1,27 +1,35 @@
-import json
 import os
 import shutil
 from datetime import datetime
 
-import pypandoc
-from flask import render_template, redirect, request, url_for, g, flash, send_from_directory, Response
+from flask import render_template, redirect, request, url_for, g, flash, send_from_directory, Response, \
+    current_app, jsonify, stream_with_context
 from flask_babel import _, get_locale
 from flask_login import current_user, login_required
+from markupsafe import Markup
+from redis.exceptions import RedisError
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from sqlalchemy.orm import joinedload
 from werkzeug.utils import secure_filename
 
 from app import db
+from app.custom_libs.activity_lib import activity_tracker
+from app.custom_libs.autocomplete_lib import complete, FIELDS as AUTOCOMPLETE_FIELDS
+from app.custom_libs.cache_lib import get_fragments, get_version_key
 from app.custom_libs.highcharts_lib import to_highchart, to_gantt_highchart, to_map_highchart
-from app.custom_libs.print_lib import ProposalText
+from app.custom_libs.pandoc_lib import EXPORT_FORMATS
+from app.custom_libs.print_lib import get_cached_export, iter_bulk_export
 from app.custom_libs.tables_lib import get_WP_table, get_budget_table, get_WPeffort_table, \
     get_proposal_deliverable_table, \
     get_proposal_milestone_table
-from app.custom_libs.trello_lib import send_proposal_to_trello
-from app.custom_libs.utilities_lib import add_admin_user, add_proposal_statuses, requires_access_level, role_required, \
-    color_diff, create_folder, make_tree
+from app.custom_libs.utilities_lib import requires_access_level, role_required, color_diff, create_folder, make_tree, \
+    conditional_response
 from app.main import bp
 from app.main.forms import ProposalForm, ParticipantForm, UserPermissionForm, \
     UploadForm
-from app.models import Proposal, Company, ProposalStatus, date_format, ACCESS, User, ROLES
+from app.models import Proposal, Company, ProposalStatus, date_format, ACCESS, User, ROLES, ProposalGraph, WP, \
+    Deliverable
 
 
 @bp.app_template_filter()
@@ -30,23 +38,64 @@ def show_diff_table(change):
     return '<p>' + ''.join(diff) + '</p>'
 
 
+@bp.app_template_filter()
+def chart_config(config):
+    if isinstance(config, bytes):
+        config = config.decode('utf-8')
+    return Markup(config)
+
+
 @bp.before_app_request
 def before_request():
     g.user = current_user
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        activity_tracker.touch(current_user.id)
     g.locale = str(get_locale())
-    add_admin_user()
-    add_proposal_statuses()
 
 
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
-    proposals = Proposal.query.all()
-    return render_template('index.html', title=_('Home'), proposals=proposals)
+    page = request.args.get('page', 1, type=int)
+    filters = {key: request.args.get(key) for key in ('status', 'call', 'topic') if request.args.get(key)}
+    pagination = Proposal.get_proposals_page(current_user, page, current_app.config['PROPOSALS_PER_PAGE'],
+                                             **filters)
+    proposals = pagination.items
+    wp_numbers = WP.get_numbers([x.id for x in proposals])
+    return render_template('index.html', title=_('Home'), proposals=proposals, pagination=pagination,
+                           wp_numbers=wp_numbers, filters=filters, statuses=ProposalStatus.get_statuses())
+
+
+@bp.route('/search', methods=['GET'])
+@login_required
+def search():
+    q = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['SEARCH_RESULTS_PER_PAGE']
+    results = {}
+    more = False
+    allowed = dict.fromkeys(['proposal', 'company', 'wp', 'deliverable'])
+    if q and not current_user.is_superuser():
+        # the matches are restricted to the visible proposals before they are counted and paginated
+        visible = sorted(x[0] for x in current_user.get_access_map().values())
+        allowed['proposal'] = visible
+        allowed['wp'] = [x[0] for x in db.session.query(WP.id).filter(WP.proposal_reference.in_(visible))] \
+            if visible else []
+        allowed['deliverable'] = [x[0] for x in db.session.query(Deliverable.id)
+                                  .join(WP, Deliverable.wp_reference == WP.id)
+                                  .filter(WP.proposal_reference.in_(visible))] if visible else []
+    options = {'wp': [joinedload(WP.ref_proposal)],
+               'deliverable': [joinedload(Deliverable.ref_wp).joinedload(WP.ref_proposal)]}
+    for model in (Proposal, Company, WP, Deliverable):
+        name = model.__tablename__
+        query, total = model.search(q, page, per_page, allowed[name]) if q else ([], 0)
+        results[name] = query.options(*options.get(name, [])).all() if total else []
+        more = more or total > page * per_page
+    next_url = url_for('main.search', q=q, page=page + 1) if more else None
+    prev_url = url_for('main.search', q=q, page=page - 1) if page > 1 else None
+    return render_template('search.html', title=_('Search'), q=q, results=results, next_url=next_url,
+                           prev_url=prev_url)
 
 
 # Proposal
@@ -81,21 +130,32 @@ def add_proposal():
 @requires_access_level(ACCESS['user'])
 @login_required
 def dashboard(proposal_acronym):
-    proposal = Proposal.get_proposal_acronym(proposal_acronym)
-    series, series_drilldown = proposal.serialise_budget()
-    chart = to_highchart(graphtype='pie', series=series, series_drilldown=series_drilldown, title='Budget Shares',
-                         subtitle='Click the slices to view the budget detail')
-    wp_table = get_WP_table(proposal_acronym)
-    effort_table = get_WPeffort_table(proposal_acronym)
-    budget_table = get_budget_table(proposal_acronym)
-    deliverables_table = get_proposal_deliverable_table(proposal_acronym)
-    milestones_table = get_proposal_milestone_table(proposal_acronym)
-    gantt = to_gantt_highchart(proposal.get_gantt_data(), 'Gantt Chart')
-    map = to_map_highchart(proposal.get_map_data(), 'Participants Geographical Distribution')
+    proposal = ProposalGraph.load_proposal(proposal_acronym)
+    version_key = get_version_key(proposal)
     tree = make_tree(create_folder(proposal_acronym))
-    return render_template('dashboard.html', proposal=proposal, chart=chart, gantt=gantt, wp_table=wp_table,
-                           budget_table=budget_table, effort_table=effort_table, deliverables_table=deliverables_table,
-                           milestones_table=milestones_table, map=map, tree=tree)
+    users = [(x.user_id, x.role) for x in proposal.user_membership]
+    return conditional_response((version_key, current_user.id, g.locale, users, tree['children']),
+                                lambda: render_template('dashboard.html', proposal=proposal, tree=tree,
+                                                        **get_fragments(proposal, DASHBOARD_FRAGMENTS, version_key)))
+
+
+def budget_chart(graph):
+    series, series_drilldown = graph.proposal.serialise_budget(graph.participants)
+    return to_highchart(graphtype='pie', series=series, series_drilldown=series_drilldown, title='Budget Shares',
+                        subtitle='Click the slices to view the budget detail')
+
+
+DASHBOARD_FRAGMENTS = {
+    'chart': budget_chart,
+    'wp_table': lambda graph: get_WP_table(graph).__html__(),
+    'effort_table': lambda graph: get_WPeffort_table(graph).__html__(),
+    'budget_table': lambda graph: get_budget_table(graph).__html__(),
+    'deliverables_table': lambda graph: get_proposal_deliverable_table(graph).__html__(),
+    'milestones_table': lambda graph: get_proposal_milestone_table(graph).__html__(),
+    'gantt': lambda graph: to_gantt_highchart(graph.proposal.get_gantt_data(graph), 'Gantt Chart'),
+    'map': lambda graph: to_map_highchart(graph.proposal.get_map_data(graph.participants),
+                                          'Participants Geographical Distribution'),
+}
 
 
 @bp.route('/<proposal_acronym>/edit', methods=['GET', 'POST'])
@@ -143,17 +203,76 @@ def delete_proposal(proposal_acronym):
 @login_required
 def export_proposal(proposal_acronym):
     proposal = Proposal.get_proposal_acronym(proposal_acronym)
-    if request.args:
-        format = request.args['format']
-    else:
-        format = ''
-    text = ProposalText(proposal)
-    filename = text.write_description()
-    new_filename = os.path.splitext(filename)[0] + f'.{format}'
-    pypandoc.convert_file(filename, format, outputfile=new_filename)
-    os.remove(filename)
-    return send_from_directory(directory=os.path.dirname(new_filename), filename=os.path.basename(new_filename),
-                               as_attachment=True)
+    format = request.args.get('format')
+    if format not in EXPORT_FORMATS:
+        flash('Please select a supported export format')
+        return redirect(url_for('main.dashboard', proposal_acronym=proposal_acronym))
+    filename = get_cached_export(proposal, format)
+    if filename:
+        return send_from_directory(directory=os.path.dirname(filename), filename=os.path.basename(filename),
+                                   as_attachment=True, attachment_filename=f'{proposal.acronym}.{format}')
+    job = current_app.task_queue.enqueue('app.tasks.export_proposal', proposal.id, format,
+                                         job_timeout=current_app.config['EXPORT_JOB_TIMEOUT'],
+                                         meta={'proposal': proposal.acronym, 'progress': 0})
+    return render_template('export.html', title='Export Proposal', proposal=proposal, format=format,
+                           job_id=job.get_id())
+
+
+def get_proposal_job(proposal_acronym, job_id):
+    ''' The background job, only if it belongs to the given proposal '''
+    try:
+        job = Job.fetch(job_id, connection=current_app.redis)
+    except (RedisError, NoSuchJobError):
+        return None
+    if job.meta.get('proposal') != proposal_acronym:
+        return None
+    return job
+
+
+@bp.route('/<proposal_acronym>/export/<job_id>', methods=['GET'])
+@role_required('edit')
+@requires_access_level(ACCESS['user'])
+@login_required
+def export_status(proposal_acronym, job_id):
+    job = get_proposal_job(proposal_acronym, job_id)
+    if job is None:
+        return jsonify(status='missing'), 404
+    data = dict(status=job.get_status(), progress=job.meta.get('progress', 0))
+    if job.is_finished:
+        data['download_url'] = url_for('main.export_download', proposal_acronym=proposal_acronym, job_id=job_id)
+    return jsonify(data)
+
+
+@bp.route('/<proposal_acronym>/export/<job_id>/download', methods=['GET'])
+@role_required('edit')
+@requires_access_level(ACCESS['user'])
+@login_required
+def export_download(proposal_acronym, job_id):
+    job = get_proposal_job(proposal_acronym, job_id)
+    if job is None or not job.is_finished:
+        flash('The export is not available, please try again')
+        return redirect(url_for('main.dashboard', proposal_acronym=proposal_acronym))
+    filename = job.result
+    format = os.path.splitext(filename)[1]
+    return send_from_directory(directory=os.path.dirname(filename), filename=os.path.basename(filename),
+                               as_attachment=True, attachment_filename=f'{proposal_acronym}{format}')
+
+
+@bp.route('/export/bulk', methods=['GET'])
+@requires_access_level(ACCESS['user'])
+@login_required
+def bulk_export():
+    format = request.args.get('format')
+    filters = {key: request.args.get(key) for key in ('status', 'call', 'topic') if request.args.get(key)}
+    if format not in EXPORT_FORMATS:
+        flash('Please select a supported export format')
+        return redirect(url_for('main.index', **filters))
+    # same role as the single proposal export
+    proposals = Proposal.get_proposals_query(current_user, min_role=ROLES['edit'], **filters) \
+        .order_by(Proposal.acronym).all()
+    filename = secure_filename('-'.join([filters.get('call', 'proposals'), filters.get('status', 'all')]))
+    return Response(stream_with_context(iter_bulk_export(proposals, format)), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}.zip'})
 
 
 # Participants
@@ -328,25 +447,37 @@ def proposal_changelog(proposal_acronym):
 @login_required
 def submit_to_trello(proposal_acronym):
     proposal = Proposal.get_proposal_acronym(proposal_acronym)
-    ## Execute in thread - currently not working for db problem
-    # user = User.query.filter_by(username=current_user.username).first()
-    # Thread(target=execute_send_trello,
-    #        args=(current_app._get_current_object(), proposal, user)).start()
     if current_user.trello_token and current_user.trello_api_key:
-        message=send_proposal_to_trello(proposal=proposal, user=current_user)
-        flash(message)
-        return redirect(url_for('main.dashboard', proposal_acronym=proposal.acronym))
+        job = current_app.task_queue.enqueue('app.tasks.sync_proposal_to_trello', proposal.id, current_user.id,
+                                             job_timeout=current_app.config['TRELLO_JOB_TIMEOUT'],
+                                             meta={'proposal': proposal.acronym, 'progress': 0})
+        return render_template('trello.html', title='Send to Trello', proposal=proposal, job_id=job.get_id())
     else:
         flash('Please set your Trello user api key and token')
         return redirect(url_for('main.user_panel', username=current_user.username))
 
 
+@bp.route("/<proposal_acronym>/totrello/<job_id>", methods=['GET'])
+@role_required('responsible')
+@requires_access_level(ACCESS['user'])
+@login_required
+def trello_status(proposal_acronym, job_id):
+    job = get_proposal_job(proposal_acronym, job_id)
+    if job is None:
+        return jsonify(status='missing'), 404
+    data = dict(status=job.get_status(), progress=job.meta.get('progress', 0))
+    if job.is_finished:
+        data['result'] = job.result
+    return jsonify(data)
+
+
 
 ### Autocomplete
 
 @bp.route('/_autocomplete/<item>', methods=['GET'])
 def autocomplete(item):
-    if item == 'topic':
-        return Response(json.dumps(Proposal.get_topics_list()), mimetype='application/json')
-    elif item == 'call':
-        return Response(json.dumps(Proposal.get_calls_list()), mimetype='application/json')
+    if item not in AUTOCOMPLETE_FIELDS:
+        return jsonify([]), 404
+    limit = min(request.args.get('limit', current_app.config['AUTOCOMPLETE_LIMIT'], type=int),
+                current_app.config['AUTOCOMPLETE_MAX_LIMIT'])
+    return jsonify(complete(item, request.args.get('q', ''), max(limit, 0)))
@@ -13,10 +13,7 @@ from app.custom_libs.utilities_lib import requires_access_level
 @login_required
 def companies():
     comps = Company.query.all()
-    if request.args:
-        searchtext = request.args['searchtext']
-    else:
-        searchtext = ''
+    searchtext = request.args.get('searchtext', '')
     return render_template('companies.html', companies=comps, searchtext=searchtext)
 
 
@@ -0,0 +1,22 @@
+from flask import render_template
+from flask_login import login_required
+
+from app.main import bp
+from app.models import ACCESS
+from app.custom_libs.analytics_lib import get_portfolio_summary
+from app.custom_libs.utilities_lib import requires_access_level
+
+
+# Portfolio
+
+@bp.app_context_processor
+def inject_access_levels():
+    return dict(ACCESS=ACCESS)
+
+
+@bp.route('/portfolio', methods=['GET'])
+@requires_access_level(ACCESS['admin'])
+@login_required
+def portfolio():
+    summary = get_portfolio_summary()
+    return render_template('portfolio.html', title='Portfolio', summary=summary)
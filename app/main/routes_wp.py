@@ -1,13 +1,14 @@
-from flask import render_template, redirect, request, url_for, flash
-from flask_login import login_required
+from flask import render_template, redirect, request, url_for, flash, g
+from flask_login import login_required, current_user
 
 from app import db
+from app.custom_libs.cache_lib import get_version_key
 from app.custom_libs.highcharts_lib import to_highchart
 from app.main import bp
 from app.main.forms import WPForm, WPParticipantForm, DeliverableForm, MilestoneForm
 from app.models import Proposal, Company, WP, ACCESS, Deliverable, Milestone
 from app.custom_libs.tables_lib import get_wp_deliverable_table, get_wp_milestone_table
-from app.custom_libs.utilities_lib import requires_access_level, role_required
+from app.custom_libs.utilities_lib import requires_access_level, role_required, conditional_response
 
 
 @bp.route('/<proposal_acronym>/add_wp', methods=['GET', 'POST'])
@@ -56,12 +57,15 @@ def wp_dashboard(proposal_acronym, wp_number):
     proposal = Proposal.get_proposal_acronym(proposal_acronym)
     wp = WP.get_wp(proposal, wp_number)
     if wp and proposal:
-        chart = to_highchart(graphtype='pie', series=wp.serialise_pm(), series_drilldown='', title='PM Distribution',
-                             value_label='PM', subtitle='')
-        deliverable_table = get_wp_deliverable_table(wp)
-        milestone_table = get_wp_milestone_table(wp)
-        return render_template('wp_dashboard.html', title='WP Dashboard', wp=wp, proposal=proposal, chart=chart,
-                               deliverable_table=deliverable_table, milestone_table=milestone_table)
+        def render():
+            chart = to_highchart(graphtype='pie', series=wp.serialise_pm(), series_drilldown=[],
+                                 title='PM Distribution', value_label='PM', subtitle='')
+            deliverable_table = get_wp_deliverable_table(wp)
+            milestone_table = get_wp_milestone_table(wp)
+            return render_template('wp_dashboard.html', title='WP Dashboard', wp=wp, proposal=proposal, chart=chart,
+                                   deliverable_table=deliverable_table, milestone_table=milestone_table)
+
+        return conditional_response((get_version_key(proposal), wp.id, current_user.id, g.locale), render)
     else:
         return render_template('errors/404.html')
 
@@ -1,21 +1,25 @@
 import base64
-import calendar
+import json
 import os
 from datetime import datetime, timedelta
 from hashlib import md5
 from time import time
 
 import jwt
-from dateutil import tz
-from dateutil.relativedelta import relativedelta
-from flask import current_app, url_for
+from flask import current_app, url_for, g, has_app_context, has_request_context
 from flask_login import UserMixin
+from sqlalchemy import and_, case, event, func, or_
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy_continuum import make_versioned
+from sqlalchemy.orm import defer, joinedload, load_only, selectinload, make_transient_to_detached
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy_continuum import make_versioned, version_class
 from sqlalchemy_continuum.plugins import FlaskPlugin
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from app import db, login
+from app.search import query_index
+from app.custom_libs.budget_lib import Budget
+from app.custom_libs.calendar_lib import ProposalCalendar
 
 ACCESS = {
     'guest': 0,
@@ -32,9 +36,88 @@ ROLES = {
 
 date_format = '%Y-%m-%d'
 
+DISSEMINATION_LEVELS = [('PU', 'Public'), ('PP', 'Restricted to other programme participants'),
+                        ('RE', 'Restricted to a group specified by the consortium'),
+                        ('CO', 'Confidential, only for members of the consortium'),
+                        ('CL restraint UE', 'Classified with the mention of the classification level RESTREINT UE'),
+                        ('CL confidential UE',
+                         'Classified with the mention of the classification level CONFIDENTIEL UE'),
+                        ('CL secret UE', 'Classified with the mention of the classification level SECRET UE')]
+
+DELIVERABLE_TYPES = [('R', 'Document, Report'), ('DEM', 'Demonstrator, Pilot, Prototype, Plan designs'),
+                     ('DEC', 'Websites, Patents filing, Press and media actions, Videos, etc.'),
+                     ('OTHER', 'Software, Technical diagram, etc.')]
+
+# Cross-request cache of the users' proposal access maps, {user_id: (expiration, access_map)}
+_access_maps = {}
+
 make_versioned(plugins=[FlaskPlugin()])
 
 
+def touch_version(obj, column='title'):
+    ''' Makes Continuum version obj in the current transaction, so the version keys and ETags built on the
+    transaction ids change. For the bulk Query.delete() of the participant associations, which Continuum doesn't
+    see: deleting them through the session would cascade to their proposal, WP and company '''
+    flag_modified(obj, column)
+
+
+def acronym_cache(model):
+    ''' Request-scoped identity cache of the model instances looked up by acronym. Outside a request (CLI
+    commands, RQ jobs sharing one app context) nothing is cached, as g would outlive the db session '''
+    if not has_request_context():
+        return {}
+    return g.setdefault('acronym_cache', {}).setdefault(model.__name__, {})
+
+
+def clear_acronym_cache(mapper, connection, target):
+    if has_request_context():
+        g.get('acronym_cache', {}).pop(type(target).__name__, None)
+
+
+class SearchableMixin(object):
+    ''' Searchable models: the rows flushed in a transaction are queued, once committed, to the search index task,
+    which loads and pushes them in bulk, so a commit never waits for the search backend '''
+
+    @classmethod
+    def search(cls, expression, page, per_page, allowed=None):
+        ''' Query of the matches of the page in rank order, and the total. allowed restricts the matches to
+        those ids before they are paginated '''
+        ids, total = query_index(cls.__tablename__, expression, page, per_page, allowed)
+        if total == 0:
+            return [], 0
+        when = [(id, i) for i, id in enumerate(ids)]
+        return cls.query.filter(cls.id.in_(ids)).order_by(case(when, value=cls.id)), total
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        for action, objects in (('changed', session.new), ('changed', session.dirty), ('removed', session.deleted)):
+            for obj in objects:
+                # the pending objects have their primary key but no identity yet during after_flush
+                if isinstance(obj, SearchableMixin) and obj.id is not None:
+                    changes = session.info.setdefault('search_changes', {'changed': set(), 'removed': set()})
+                    changes[action].add((obj.__tablename__, obj.id))
+
+    @classmethod
+    def after_commit(cls, session):
+        changes = session.info.pop('search_changes', None)
+        if not changes or not (changes['changed'] or changes['removed']) or not has_app_context():
+            return
+        try:
+            current_app.task_queue.enqueue('app.tasks.update_search_index', sorted(changes['changed']),
+                                           sorted(changes['removed']))
+        except Exception:
+            current_app.logger.warning('Search index update could not be queued', exc_info=True)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_changes', None)
+
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
+db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+
+
 class PaginatedAPIMixin(object):
     @staticmethod
     def to_collection_dict(query, page, per_page, endpoint, **kwargs):
@@ -58,6 +141,65 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    # Columns the cursor pagination can sort by: unique together with the id and never null
+    __cursor_fields__ = ('id',)
+
+    @staticmethod
+    def encode_cursor(value, id):
+        return base64.urlsafe_b64encode(json.dumps([value, id]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        ''' (sort value, id) of the cursor, ValueError if it is not a valid cursor '''
+        try:
+            value, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except (TypeError, ValueError, UnicodeError) as e:
+            raise ValueError(f'invalid cursor {cursor}') from e
+        if not isinstance(id, int):
+            raise ValueError(f'invalid cursor {cursor}')
+        return value, id
+
+    @classmethod
+    def to_cursor_dict(cls, query, after, per_page, endpoint, sort='id', with_total=False, **kwargs):
+        ''' Keyset paginated collection: after is the opaque cursor of the last item of the previous page (empty
+        for the first page), so every page is an indexed range scan without OFFSET. The total COUNT(*) is only
+        run when with_total is set. Raises ValueError for an invalid cursor or sort field '''
+        if sort not in cls.__cursor_fields__:
+            raise ValueError(f'sort must be one of {", ".join(cls.__cursor_fields__)}')
+        per_page = max(per_page, 1)
+        column = getattr(cls, sort)
+        page_query = query.order_by(None).order_by(column, cls.id)
+        if after:
+            value, last_id = cls.decode_cursor(after)
+            if isinstance(value, bool) or not isinstance(value, column.type.python_type):
+                raise ValueError(f'invalid cursor {after}')
+            if sort == 'id':
+                page_query = page_query.filter(cls.id > last_id)
+            else:
+                page_query = page_query.filter(or_(column > value, and_(column == value, cls.id > last_id)))
+        items = page_query.limit(per_page + 1).all()
+        if with_total:
+            kwargs['with_total'] = 1
+        next_cursor = cls.encode_cursor(getattr(items[per_page - 1], sort), items[per_page - 1].id) \
+            if len(items) > per_page else None
+        data = {
+            'items': [item.to_dict() for item in items[:per_page]],
+            '_meta': {
+                'per_page': per_page,
+                'sort': sort,
+                'after': after or None,
+                'next': next_cursor
+            },
+            '_links': {
+                'self': url_for(endpoint, after=after or '', per_page=per_page, sort=sort, **kwargs),
+                'next': url_for(endpoint, after=next_cursor, per_page=per_page, sort=sort,
+                                **kwargs) if next_cursor else None
+            }
+        }
+        if with_total:
+            data['_meta']['total_items'] = query.order_by(None).count()
+        return data
+
 
 class User(UserMixin, PaginatedAPIMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -84,11 +226,35 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
     def allowed(self, access_level):
         return self.access >= access_level
 
+    def get_access_map(self):
+        ''' {proposal_acronym: (proposal_id, role)} of the user, loaded in one query and cached for the
+        request (and across requests for PERMISSION_CACHE_TTL seconds when it is set) '''
+        cache = g.setdefault('access_maps', {}) if has_request_context() else {}
+        if self.id in cache:
+            return cache[self.id]
+        ttl = current_app.config['PERMISSION_CACHE_TTL']
+        cached = _access_maps.get(self.id)
+        if ttl and cached and cached[0] > time():
+            access_map = cached[1]
+        else:
+            rows = db.session.query(Proposal.acronym, Proposal.id, User_Proposal.role) \
+                .join(User_Proposal, User_Proposal.proposal_id == Proposal.id) \
+                .filter(User_Proposal.user_id == self.id).all()
+            access_map = {acronym: (id, role) for acronym, id, role in rows}
+            if ttl:
+                _access_maps[self.id] = (time() + ttl, access_map)
+        cache[self.id] = access_map
+        return access_map
+
+    def clear_access_map(self):
+        _access_maps.pop(self.id, None)
+        if has_request_context():
+            g.get('access_maps', {}).pop(self.id, None)
+
     def proposal_role(self, proposal_acronym):
-        proposal = Proposal.get_proposal_acronym(proposal_acronym)
-        association = User_Proposal.query.filter_by(user=self, proposal=proposal).first()
-        if association:
-            return association.role
+        access = self.get_access_map().get(proposal_acronym)
+        if access:
+            return access[1]
         else:
             return None
 
@@ -118,6 +284,19 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
             return
         return User.query.get(id)
 
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'username': self.username,
+            'name': self.name,
+            'surname': self.surname,
+            'last_seen': self.last_seen.isoformat() + 'Z' if self.last_seen else None,
+            '_links': {
+                'self': url_for('api.get_user', id=self.id)
+            }
+        }
+        return data
+
     def get_token(self, expires_in=86400):
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(seconds=60):
@@ -151,16 +330,47 @@ class ProposalStatus(db.Model):
     description = db.Column(db.String(1024))
     badge_type = db.Column(db.String(140))
 
+    # In-process registry of detached statuses keyed by name (None until loaded), cleared on any status write
+    _registry = None
+
     def __repr__(self):
         return f'{self.status}'
 
     @classmethod
-    def get_statuses(self):
-        return [(x.status, x.status) for x in self.query.all()]
+    def load_registry(cls):
+        rows = db.session.query(cls.id, cls.status, cls.description, cls.badge_type).order_by(cls.id).all()
+        registry = {}
+        for id, status, description, badge_type in rows:
+            item = cls(id=id, status=status, description=description, badge_type=badge_type)
+            make_transient_to_detached(item)
+            registry[status] = item
+        cls._registry = registry
+        return registry
+
+    @classmethod
+    def clear_registry(cls):
+        cls._registry = None
+
+    @classmethod
+    def get_statuses(cls):
+        registry = cls._registry if cls._registry is not None else cls.load_registry()
+        return [(x, x) for x in registry]
 
     @classmethod
     def get_status(cls, status_name):
-        return cls.query.filter_by(status=status_name).first()
+        registry = cls._registry if cls._registry is not None else cls.load_registry()
+        status = registry.get(status_name)
+        if status is None:
+            return None
+        return db.session.merge(status, load=False)
+
+
+def clear_status_registry(mapper, connection, target):
+    ProposalStatus.clear_registry()
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(ProposalStatus, _event, clear_status_registry)
 
 
 class Association(db.Model):
@@ -241,9 +451,11 @@ class User_Proposal(db.Model):
         return f'<{self.proposal} {self.user} {self.role}>'
 
 
-class Proposal(PaginatedAPIMixin, db.Model):
+class Proposal(SearchableMixin, PaginatedAPIMixin, db.Model):
     __versioned__ = {}
     __tablename__ = 'proposal'
+    __searchable__ = ['acronym', 'title', 'description', 'call', 'topic']
+    __cursor_fields__ = ('id', 'acronym')
     id = db.Column(db.Integer, primary_key=True)
     acronym = db.Column(db.String(64), index=True, unique=True, nullable=False)
     title = db.Column(db.String(256), nullable=False)
@@ -310,6 +522,7 @@ class Proposal(PaginatedAPIMixin, db.Model):
             Association.query.filter_by(company=company, proposal=self).delete()
             for wp in self.working_packages:
                 WP_Company.query.filter_by(company=company, wp=wp).delete()
+            touch_version(self)
             db.session.commit()
 
     def get_participant(self, company):
@@ -327,11 +540,13 @@ class Proposal(PaginatedAPIMixin, db.Model):
             association = User_Proposal.query.filter_by(user=user, proposal=self).first()
             association.role = role
             db.session.commit()
+        user.clear_access_map()
 
     def remove_user(self, user):
         if self.user_is_included(user):
             User_Proposal.query.filter_by(user=user, proposal=self).delete()
             db.session.commit()
+            user.clear_access_map()
 
     def user_is_included(self, user):
         return User_Proposal.query.filter_by(user=user, proposal=self).count() > 0
@@ -349,14 +564,36 @@ class Proposal(PaginatedAPIMixin, db.Model):
         self.start_date = datetime.strptime(data['start_date'], date_format)
         self.duration_months = data['duration_months']
         db.session.commit()
+        # access maps are keyed by acronym
+        _access_maps.clear()
+
+    def get_budget(self, participants=None):
+        if participants is None:
+            participants = self.proposal_participant
+        return Budget.from_participants(self, participants)
 
     def get_remaining_budget(self):
-        assigned = [((x.personnel_cost + x.other_direct_costs) * (
-                    1 + self.indirect_costs_rate) + x.subcontracting_cost) * x.proposal.get_reimbursement_rate(
-            x.company, decimal=True)
-                    for x
-                    in self.proposal_participant]
-        return self.budget - sum(assigned)
+        return self.budget - float(self.get_budget().contribution.sum())
+
+    def get_transaction_id(self):
+        ''' Latest SQLAlchemy-Continuum transaction touching the proposal or any of its participants, WPs,
+        WP efforts, deliverables and milestones (deletions included), computed in one round trip '''
+        ProposalVersion, AssociationVersion, WPVersion, WP_CompanyVersion, DeliverableVersion, MilestoneVersion = \
+            [version_class(x) for x in (Proposal, Association, WP, WP_Company, Deliverable, Milestone)]
+        wp_ids = db.session.query(WPVersion.id).filter(WPVersion.proposal_reference == self.id)
+        queries = [
+            db.session.query(func.max(ProposalVersion.transaction_id)).filter(ProposalVersion.id == self.id),
+            db.session.query(func.max(AssociationVersion.transaction_id))
+                .filter(AssociationVersion.proposal_id == self.id),
+            db.session.query(func.max(WPVersion.transaction_id)).filter(WPVersion.proposal_reference == self.id),
+            db.session.query(func.max(WP_CompanyVersion.transaction_id)).filter(WP_CompanyVersion.WP_id.in_(wp_ids)),
+            db.session.query(func.max(DeliverableVersion.transaction_id))
+                .filter(DeliverableVersion.wp_reference.in_(wp_ids)),
+            db.session.query(func.max(MilestoneVersion.transaction_id))
+                .filter(MilestoneVersion.wp_reference.in_(wp_ids)),
+        ]
+        rows = queries[0].union_all(*queries[1:]).all()
+        return max([x[0] for x in rows if x[0] is not None], default=0)
 
     def get_reimbursement_rate(self, company, decimal=False):
         if self.action_type == 'IA':
@@ -370,53 +607,51 @@ class Proposal(PaginatedAPIMixin, db.Model):
         else:
             return 100
 
-    def serialise_budget(self):
-        data = [{'name': x.company.acronym,
-                 'y': (x.personnel_cost + x.other_direct_costs) * (
-                         1 + self.indirect_costs_rate) + x.subcontracting_cost,
-                 'drilldown': x.company.acronym} for x in self.proposal_participant]
+    def serialise_budget(self, participants=None):
+        budget = self.get_budget(participants)
+        data = [{'name': x['participant'], 'y': x['total_costs'], 'drilldown': x['participant']}
+                for x in budget.rows()]
         # data.append({'name': 'Not Assigned', 'y': self.get_remaining_budget(), 'drilldown': 'null'})
 
         series_drilldown = list()
-        for x in self.proposal_participant:
-            a = ['Personnel Cost', x.personnel_cost]
-            b = ['Other Direct Cost', x.other_direct_costs]
-            c = ['Subcontracting Cost', x.subcontracting_cost]
-            d = ['Indirect Cost', (x.personnel_cost + x.other_direct_costs) * self.indirect_costs_rate]
-            name = x.company.acronym
-            id = x.company.acronym
+        for x in budget.rows():
+            a = ['Personnel Cost', x['personnel_costs']]
+            b = ['Other Direct Cost', x['other_direct_costs']]
+            c = ['Subcontracting Cost', x['subcontracting_costs']]
+            d = ['Indirect Cost', x['indirect_costs']]
+            name = x['participant']
+            id = x['participant']
             series_drilldown.append({'name': name, 'id': id, 'data': [a, b, c, d]})
 
         series = [{'name': 'Budget Shares', 'data': data}]
 
         return series, series_drilldown
 
-    def get_gantt_data(self):
+    def get_calendar(self):
+        return ProposalCalendar(self.start_date, self.duration_months)
+
+    def get_gantt_data(self, graph=None):
+        if graph is None:
+            graph = ProposalGraph(self)
+        months = self.get_calendar()
         data = [{'name': f'WP{x.number} - {x.title}', 'id': f'{x.number}',
-                 'start': self.start_date + relativedelta(months=x.start_month),
-                 'end': self.start_date + relativedelta(months=x.end_month)} for x in self.working_packages]
+                 'start': months.timestamp(x.start_month),
+                 'end': months.timestamp(x.end_month)} for x in graph.working_packages]
 
-        for wp in self.working_packages:
-            for deliverable in wp.deliverables:
+        for wp in graph.working_packages:
+            for deliverable in graph.get_deliverables(wp):
                 data.append({'name': f'D{wp.number}.{deliverable.number} - {deliverable.title}',
                              'id': f'{wp.number}.{deliverable.number}',
-                             'start': self.start_date + relativedelta(months=deliverable.due_month),
-                             'end': self.start_date + relativedelta(months=deliverable.due_month + 1),
-                             'responsible': deliverable.responsible, 'milestone': 'true', 'parent': f'{wp.number}'})
-
-        for element in data:
-            element['start'] = datetime.combine(element['start'], datetime.min.time())
-            element['start'] = (calendar.timegm(element['start'].astimezone(tz.UTC).utctimetuple())) * 1000
-            element['end'] = datetime.combine(element['end'], datetime.min.time())
-            element['end'] = (calendar.timegm(element['end'].astimezone(tz.UTC).utctimetuple())) * 1000
-            # element['start'] = f'Date.UTC({element["start"].year},{element["start"].month},{element["start"].day})'
-            # element['end'] = f'Date.UTC({element["end"].year},{element["end"].month},{element["end"].day})'
+                             'start': months.timestamp(deliverable.due_month),
+                             'end': months.timestamp(deliverable.due_month + 1),
+                             'responsible': deliverable.responsible, 'milestone': True, 'parent': f'{wp.number}'})
+
         series = [{'name': f'{self.acronym}', 'data': data}]
         return series
 
-    def get_map_data(self):
+    def get_map_data(self, participants=None):
         d=dict()
-        for x in self.proposal_participant:
+        for x in self.proposal_participant if participants is None else participants:
             country=f'{x.company.country}'.lower().replace('uk','gb')
             if country in d:
                 d[country].append(f'{x.company.acronym}')
@@ -424,7 +659,7 @@ class Proposal(PaginatedAPIMixin, db.Model):
                 d[country] = [f'{x.company.acronym}']
         data = [[key, '<br>'.join(value)] for key, value in d.items()]
 
-        dataLabels = {'enabled': 'true', 'color': "#FFFFFF"}
+        dataLabels = {'enabled': True, 'color': "#FFFFFF"}
         tooltip = {'pointFormat': '{point.name}', 'headerFormat': ''}
         series = [{'name': 'Country', 'data': data, 'dataLabels' : dataLabels, 'tooltip': tooltip}]
         return series
@@ -433,21 +668,69 @@ class Proposal(PaginatedAPIMixin, db.Model):
     def get_proposals(cls):
         return cls.query.all()
 
+    @classmethod
+    def get_portfolio_budget(cls, proposal_ids=None):
+        ''' Budget of every participant of the given proposals (all of them by default) in one query '''
+        query = db.session.query(Association.proposal_id, Association.participant_number, Company.acronym,
+                                 Company.country, Company.company_type, Association.personnel_cost,
+                                 Association.other_direct_costs, Association.subcontracting_cost,
+                                 cls.indirect_costs_rate, cls.action_type) \
+            .join(Company, Company.id == Association.company_id).join(cls, cls.id == Association.proposal_id)
+        if proposal_ids is not None:
+            query = query.filter(Association.proposal_id.in_(proposal_ids))
+        return Budget.from_query(query)
+
     @classmethod
     def get_proposal_acronym(cls, acronym):
-        return cls.query.filter_by(acronym=acronym).first()
+        ''' The proposal, by the id already resolved by role_required for this request when available '''
+        cache = acronym_cache(cls)
+        if acronym not in cache:
+            proposal_id = g.get('proposal_ids', {}).get(acronym) if has_request_context() else None
+            if proposal_id is not None:
+                cache[acronym] = cls.query.get(proposal_id)
+            else:
+                cache[acronym] = cls.query.filter_by(acronym=acronym).first()
+        return cache[acronym]
 
     @classmethod
-    def get_topics_list(cls):
-        return list(set([x.topic for x in cls.query.all()]))
+    def get_proposals_query(cls, user=None, status=None, call=None, topic=None, min_role=None):
+        ''' Proposals visible to the user (all of them without a user), filtered by status, call and topic.
+        min_role restricts them to the proposals where the user has at least that role '''
+        query = cls.query
+        if user is not None and not user.is_superuser():
+            query = query.join(User_Proposal, User_Proposal.proposal_id == cls.id) \
+                .filter(User_Proposal.user_id == user.id)
+            if min_role is not None:
+                query = query.filter(User_Proposal.role >= min_role)
+        if status:
+            query = query.filter(cls.status.has(status=status))
+        if call:
+            query = query.filter(cls.call == call)
+        if topic:
+            query = query.filter(cls.topic == topic)
+        return query
 
     @classmethod
-    def get_calls_list(cls):
-        return list(set([x.call for x in cls.query.all()]))
+    def get_proposals_page(cls, user, page, per_page, status=None, call=None, topic=None):
+        ''' Paginated proposal cards visible to the user: large text columns are deferred and
+        participants are batch loaded, so the page cost does not grow with the portfolio '''
+        query = cls.get_proposals_query(user, status, call, topic) \
+            .options(defer(cls.description),
+                     joinedload(cls.status),
+                     selectinload(cls.proposal_participant).joinedload(Association.company)
+                     .load_only(Company.acronym))
+        return query.order_by(cls.acronym).paginate(page, per_page, False)
+
+    @classmethod
+    def get_distinct_values(cls, field):
+        ''' Distinct non empty values of a proposal column, computed by the database '''
+        column = getattr(cls, field)
+        return [x[0] for x in db.session.query(column).filter(column.isnot(None), column != '').distinct()]
 
 
-class Company(db.Model):
+class Company(SearchableMixin, db.Model):
     __tablename__ = 'company'
+    __searchable__ = ['acronym', 'name', 'description', 'country', 'specialisation']
     id = db.Column(db.Integer, primary_key=True)
     acronym = db.Column(db.String(64), index=True, unique=True, nullable=False)
     name = db.Column(db.String(256), nullable=False)
@@ -472,12 +755,16 @@ class Company(db.Model):
 
     @classmethod
     def get_company_acronym(cls, acronym):
-        return cls.query.filter_by(acronym=acronym).first()
+        cache = acronym_cache(cls)
+        if acronym not in cache:
+            cache[acronym] = cls.query.filter_by(acronym=acronym).first()
+        return cache[acronym]
 
 
-class WP(db.Model):
+class WP(SearchableMixin, db.Model):
     __versioned__ = {}
     __tablename__ = 'wp'
+    __searchable__ = ['title', 'description']
     id = db.Column(db.Integer, primary_key=True)
     number = db.Column(db.Integer, nullable=False)
     title = db.Column(db.String(256), nullable=False)
@@ -509,6 +796,17 @@ class WP(db.Model):
     def get_wp(cls, proposal, number):
         return cls.query.filter_by(ref_proposal=proposal, number=number).first()
 
+    @classmethod
+    def get_numbers(cls, proposal_ids):
+        ''' WP numbers of several proposals in one query, as {proposal_id: [numbers]} '''
+        numbers = {x: [] for x in proposal_ids}
+        if proposal_ids:
+            rows = db.session.query(cls.proposal_reference, cls.number) \
+                .filter(cls.proposal_reference.in_(proposal_ids)).order_by(cls.number).all()
+            for proposal_id, number in rows:
+                numbers[proposal_id].append(number)
+        return numbers
+
     def is_included(self, company):
         return WP_Company.query.filter_by(company=company, wp=self).count() > 0
 
@@ -528,15 +826,16 @@ class WP(db.Model):
             db.session.commit()
 
     def get_leader_acronym(self):
-        association = WP_Company.query.filter_by(wp=self, leader=True).first()
-        if association:
-            return association.company.acronym
+        leaders = [x for x in self.company_participant if x.leader]
+        if leaders:
+            return leaders[0].company.acronym
         else:
             return None
 
     def remove_participant(self, company):
         if self.is_included(company):
             WP_Company.query.filter_by(company=company, wp=self).delete()
+            touch_version(self)
             db.session.commit()
 
     def get_participant(self, company):
@@ -555,9 +854,10 @@ class WP(db.Model):
         return series
 
 
-class Deliverable(db.Model):
+class Deliverable(SearchableMixin, db.Model):
     __versioned__ = {}
     __tablename__ = 'deliverable'
+    __searchable__ = ['title', 'description']
     id = db.Column(db.Integer, primary_key=True)
     number = db.Column(db.Integer, nullable=False)
     title = db.Column(db.String(256), nullable=False)
@@ -605,6 +905,91 @@ class Milestone(db.Model):
         return cls.query.filter_by(ref_wp=wp, number=number).first()
 
 
+class ProposalGraph(object):
+    """Proposal object graph (participants, users, WPs, WP efforts, deliverables and milestones)
+    loaded in a fixed number of queries, whatever the size of the proposal."""
+
+    def __init__(self, proposal):
+        self.proposal = proposal
+        self.participants = Association.query.filter_by(proposal_id=proposal.id) \
+            .options(joinedload(Association.company)).order_by(Association.participant_number).all()
+        self.companies = [x.company for x in self.participants]
+        self.memberships = User_Proposal.query.filter_by(proposal_id=proposal.id) \
+            .options(joinedload(User_Proposal.user)).all()
+        acronym_cache(Proposal)[proposal.acronym] = proposal
+        acronym_cache(Company).update({x.acronym: x for x in self.companies})
+        self.working_packages = WP.query.filter_by(proposal_reference=proposal.id) \
+            .options(selectinload(WP.company_participant).joinedload(WP_Company.company)) \
+            .order_by(WP.number).all()
+        wp_ids = [x.id for x in self.working_packages]
+        self.deliverables = {x: [] for x in wp_ids}
+        self.milestones = {x: [] for x in wp_ids}
+        if wp_ids:
+            for deliverable in Deliverable.query.filter(Deliverable.wp_reference.in_(wp_ids)) \
+                    .order_by(Deliverable.number).all():
+                self.deliverables[deliverable.wp_reference].append(deliverable)
+            for milestone in Milestone.query.filter(Milestone.wp_reference.in_(wp_ids)) \
+                    .order_by(Milestone.number).all():
+                self.milestones[milestone.wp_reference].append(milestone)
+
+    def __repr__(self):
+        return f'<Graph {self.proposal.acronym}>'
+
+    @classmethod
+    def load_proposal(cls, proposal_acronym):
+        ''' The proposal with its status, participants and users, without the rest of the graph '''
+        return Proposal.query.filter_by(acronym=proposal_acronym) \
+            .options(joinedload(Proposal.status),
+                     selectinload(Proposal.proposal_participant).joinedload(Association.company),
+                     selectinload(Proposal.user_membership).joinedload(User_Proposal.user)).first()
+
+    @classmethod
+    def load(cls, proposal_acronym):
+        proposal = cls.load_proposal(proposal_acronym)
+        if proposal is None:
+            return None
+        return cls(proposal)
+
+    def get_deliverables(self, wp):
+        return self.deliverables.get(wp.id, [])
+
+    def get_milestones(self, wp):
+        return self.milestones.get(wp.id, [])
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Proposal, _event, clear_acronym_cache)
+    event.listen(Company, _event, clear_acronym_cache)
+
+
+class TrelloCard(db.Model):
+    ''' Trello card created for a WP, deliverable or milestone on a board, with the hash of the synced content '''
+    __tablename__ = 'trello_card'
+    id = db.Column(db.Integer, primary_key=True)
+    board_id = db.Column(db.String(64), index=True, nullable=False)
+    item_type = db.Column(db.String(16), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    card_id = db.Column(db.String(64), nullable=False)
+    content_hash = db.Column(db.String(64))
+    __table_args__ = (db.UniqueConstraint('board_id', 'item_type', 'item_id'),)
+
+    def __repr__(self):
+        return f'<TrelloCard {self.item_type} {self.item_id} -> {self.card_id}>'
+
+    @classmethod
+    def get_board_cards(cls, board_id):
+        ''' Cards of the board keyed by (item_type, item_id) '''
+        return {(x.item_type, x.item_id): x for x in cls.query.filter_by(board_id=board_id)}
+
+    @classmethod
+    def get_board_ids(cls, item_type, item_ids):
+        ''' Boards holding a card of the given items '''
+        if not item_ids:
+            return []
+        query = db.session.query(cls.board_id).filter(cls.item_type == item_type, cls.item_id.in_(item_ids))
+        return [x.board_id for x in query.distinct()]
+
+
 class ToDo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     assigned_to = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -615,4 +1000,6 @@ class ToDo(db.Model):
     proposal_reference = db.Column(db.Integer, db.ForeignKey('proposal.id'))
 
 
+SEARCHABLE_MODELS = {x.__tablename__: x for x in (Proposal, Company, WP, Deliverable)}
+
 db.configure_mappers()
@@ -1,27 +1,143 @@
+import json
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from elasticsearch.helpers import bulk
 from flask import current_app
 
+from app import db
+from app.custom_libs import fulltext_lib
+
+# Documents are indexed on Elasticsearch when ELASTICSEARCH_URL is set, otherwise on the local full-text
+# index of the primary database (see fulltext_lib), behind the same functions.
+
+
+def get_document(model):
+    return {field: getattr(model, field) for field in model.__searchable__}
+
 
 def add_to_index(index, model):
     if not current_app.elasticsearch:
+        fulltext_lib.index_documents([(index, model.id, get_document(model))])
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    current_app.elasticsearch.index(index=index, id=model.id, body=get_document(model))
 
 
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
+        fulltext_lib.remove_documents([(index, model.id)])
         return
     current_app.elasticsearch.delete(index=index, id=model.id)
 
 
-def query_index(index, query, page, per_page):
+def bulk_update_index(documents, removed):
+    ''' Indexes the documents, [(index, id, payload)], and removes the removed ones, [(index, id)], in bulk
+    requests. Returns the number of successful actions; failures other than removing a missing document are logged '''
     if not current_app.elasticsearch:
+        return fulltext_lib.index_documents(documents) + fulltext_lib.remove_documents(removed)
+    actions = [{'_op_type': 'index', '_index': index, '_id': id, '_source': payload}
+               for index, id, payload in documents]
+    actions += [{'_op_type': 'delete', '_index': index, '_id': id} for index, id in removed]
+    if not actions:
+        return 0
+    success, errors = bulk(current_app.elasticsearch, actions, raise_on_error=False)
+    for error in errors:
+        action, result = next(iter(error.items()))
+        if not (action == 'delete' and result.get('status') == 404):
+            current_app.logger.warning(f'Search index {action} failed: {result}')
+    return success
+
+
+def query_index(index, query, page, per_page, ids=None):
+    ''' Ids of the matches of the page and the total number of matches, only among the given ids when set '''
+    if not current_app.elasticsearch:
+        return fulltext_lib.query_index(index, query, page, per_page, ids)
+    if ids is not None and not ids:
         return [], 0
+    match = {'multi_match': {'query': query, 'fields': ['*']}}
+    if ids is not None:
+        match = {'bool': {'must': match, 'filter': {'ids': {'values': [str(x) for x in ids]}}}}
     search = current_app.elasticsearch.search(
         index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
+        body={'query': match, 'from': (page - 1) * per_page, 'size': per_page})
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     return ids, search['hits']['total']['value']
+
+
+# --------------- Bulk reindex ------------------------#
+# The rows are read in chunks ordered by id (keyset pagination, only the searchable columns), the bulk
+# payload of each chunk (the Elasticsearch NDJSON body, or the local index rows) is built by a pool of
+# worker processes while the next chunks are read, and the payloads are sent in order, so the id of the
+# last sent chunk can be checkpointed and a reindex resumed from it.
+
+def iter_chunks(model, chunk_size, after=0):
+    ''' (last id, [(id, payload)]) of the model rows with id > after, in chunks of chunk_size rows '''
+    columns = [getattr(model, x) for x in model.__searchable__]
+    while True:
+        rows = db.session.query(model.id, *columns).filter(model.id > after).order_by(model.id) \
+            .limit(chunk_size).all()
+        if not rows:
+            return
+        after = rows[-1][0]
+        yield after, [(x[0], dict(zip(model.__searchable__, x[1:]))) for x in rows]
+
+
+def build_bulk_payload(index, rows, elasticsearch):
+    documents = [(index, id, payload) for id, payload in rows]
+    if not elasticsearch:
+        return fulltext_lib.build_rows(documents)
+    lines = []
+    for index, id, payload in documents:
+        lines.append(json.dumps({'index': {'_index': index, '_id': id}}))
+        lines.append(json.dumps(payload, default=str))
+    return '\n'.join(lines) + '\n'
+
+
+def send_bulk_payload(payload):
+    if not current_app.elasticsearch:
+        fulltext_lib.insert_rows(payload)
+        db.session.commit()
+        return
+    response = current_app.elasticsearch.bulk(body=payload)
+    if response.get('errors'):
+        for item in response['items']:
+            result = item.get('index', {})
+            if result.get('error'):
+                current_app.logger.warning(f'Search index failed: {result}')
+
+
+def clear_index(index):
+    if not current_app.elasticsearch:
+        fulltext_lib.clear_index(index)
+        db.session.commit()
+        return
+    current_app.elasticsearch.indices.delete(index=index, ignore=[400, 404])
+
+
+def reindex(model, chunk_size, workers, after=0, on_chunk=None):
+    ''' Indexes the model rows with id > after (all of them, after clearing the index, when after is 0).
+    on_chunk(last_id, count) is called once each chunk is sent. Returns the number of indexed documents '''
+    index = model.__tablename__
+    if not after:
+        clear_index(index)
+    elasticsearch = bool(current_app.elasticsearch)
+    total = 0
+    pending = deque()
+
+    def send_oldest():
+        last_id, count, future = pending.popleft()
+        send_bulk_payload(future.result())
+        if on_chunk:
+            on_chunk(last_id, count)
+        return count
+
+    # spawned workers don't inherit the open database connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for last_id, rows in iter_chunks(model, chunk_size, after):
+            pending.append((last_id, len(rows), executor.submit(build_bulk_payload, index, rows, elasticsearch)))
+            if len(pending) > workers:
+                total += send_oldest()
+        while pending:
+            total += send_oldest()
+    return total
@@ -0,0 +1,73 @@
+import sys
+
+from rq import get_current_job
+
+from app import create_app, db
+from app.custom_libs.print_lib import export_proposal_file
+from app.custom_libs.trello_lib import send_proposal_to_trello
+from app.models import Proposal, User, SEARCHABLE_MODELS
+from app.search import get_document, bulk_update_index
+
+app = create_app()
+app.app_context().push()
+
+
+def _set_task_progress(progress):
+    job = get_current_job()
+    if job:
+        job.meta['progress'] = progress
+        job.save_meta()
+
+
+def export_proposal(proposal_id, format):
+    try:
+        _set_task_progress(0)
+        proposal = Proposal.query.get(proposal_id)
+        filename = export_proposal_file(proposal, format, progress=_set_task_progress)
+        _set_task_progress(100)
+        return filename
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        raise
+    finally:
+        db.session.remove()
+
+
+def sync_proposal_to_trello(proposal_id, user_id):
+    try:
+        _set_task_progress(0)
+        proposal = Proposal.query.get(proposal_id)
+        user = User.query.get(user_id)
+        result = send_proposal_to_trello(proposal, user,
+                                         progress=lambda done, total: _set_task_progress(100 * done // total))
+        _set_task_progress(100)
+        return result
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        raise
+    finally:
+        db.session.remove()
+
+
+def update_search_index(changed, removed):
+    ''' Pushes the changed rows, [(index, id)], to the search index and removes the removed ones in bulk '''
+    try:
+        ids = {}
+        for index, id in changed:
+            ids.setdefault(index, set()).add(id)
+        documents = []
+        removed = set(map(tuple, removed))
+        for index, model_ids in ids.items():
+            model = SEARCHABLE_MODELS[index]
+            found = model.query.filter(model.id.in_(model_ids)).all()
+            documents += [(index, x.id, get_document(x)) for x in found]
+            # rows deleted since the commit that queued them
+            removed.update((index, x) for x in model_ids - {x.id for x in found})
+        count = bulk_update_index(documents, sorted(removed))
+        db.session.commit()
+        return count
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        raise
+    finally:
+        db.session.remove()
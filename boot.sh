@@ -10,4 +10,5 @@ do
     sleep 5
 done
 
+flask seed
 python main.py
\ No newline at end of file
@@ -23,8 +23,27 @@ class Config(object):
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
     POSTS_PER_PAGE = 25
+    PROPOSALS_PER_PAGE = 24
+    SEARCH_RESULTS_PER_PAGE = 10
+    AUTOCOMPLETE_LIMIT = 10
+    AUTOCOMPLETE_MAX_LIMIT = 50
     DOWNLOAD_FOLDER = 'static'
     UPLOAD_FOLDER = 'static'
     MAX_CONTENT_PATH = 2 * 1024 * 1024
     FLASK_ADMIN_SWATCH = 'simplex'
     ADMIN_PASS = os.environ.get('ADMIN_PASS') or 'nous_pass'
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+    PERMISSION_CACHE_TTL = int(os.environ.get('PERMISSION_CACHE_TTL') or 0)
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 86400)
+    ANALYTICS_CACHE_TTL = int(os.environ.get('ANALYTICS_CACHE_TTL') or 3600)
+    EXPORT_JOB_TIMEOUT = int(os.environ.get('EXPORT_JOB_TIMEOUT') or 600)
+    EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_BYTES') or 512 * 1024 * 1024)
+    PANDOC_WORKERS = int(os.environ.get('PANDOC_WORKERS') or 0)
+    PANDOC_QUEUE_SIZE = int(os.environ.get('PANDOC_QUEUE_SIZE') or 16)
+    PANDOC_TIMEOUT = int(os.environ.get('PANDOC_TIMEOUT') or 300)
+    PANDOC_MEMORY_LIMIT_MB = int(os.environ.get('PANDOC_MEMORY_LIMIT_MB') or 2048)
+    TRELLO_JOB_TIMEOUT = int(os.environ.get('TRELLO_JOB_TIMEOUT') or 900)
+    TRELLO_WORKERS = int(os.environ.get('TRELLO_WORKERS') or 4)
+    TRELLO_RATE_LIMIT = int(os.environ.get('TRELLO_RATE_LIMIT') or 90)
+    TRELLO_RETRIES = int(os.environ.get('TRELLO_RETRIES') or 5)
+    SEED_ON_STARTUP = (os.environ.get('SEED_ON_STARTUP') or 'false').lower() == 'true'
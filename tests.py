@@ -1,8 +1,23 @@
 #!/usr/bin/env python
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import io
+import json
+import os
+import shutil
+import tempfile
 import unittest
-from app import create_app, db
-from app.models import User, Proposal, Company, WP, Deliverable, Milestone
+import zipfile
+from unittest import mock
+from app import create_app, cli, db, search
+from app import tasks
+from app.custom_libs.budget_lib import Budget
+from app.custom_libs.calendar_lib import ProposalCalendar, to_timestamp
+from app.custom_libs import fulltext_lib
+from app.custom_libs.analytics_lib import get_portfolio_version
+from app.custom_libs.autocomplete_lib import PrefixIndex
+from app.custom_libs.cache_lib import get_version_key
+from app.models import User, Proposal, Company, WP, Deliverable, Milestone, PaginatedAPIMixin, ROLES, \
+    ACCESS
 from config import Config
 
 import lorem
@@ -109,5 +124,378 @@ class ComponentModelCase(unittest.TestCase):
         db.session.commit()
 
 
+class CursorCase(unittest.TestCase):
+    acronyms = ('CURSORC', 'CURSORA', 'CURSORB')
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.request_context = self.app.test_request_context()
+        self.request_context.push()
+        db.create_all()
+        for acronym in self.acronyms:
+            db.session.add(Proposal(acronym=acronym, title=acronym, description='', budget=1, action_type='IA',
+                                    call='HEU', topic='LC-TT-3-51', start_date=datetime.today(), duration_months=12,
+                                    indirect_costs_rate=0.25))
+        db.session.commit()
+        self.query = Proposal.query.filter(Proposal.acronym.in_(self.acronyms))
+
+    def tearDown(self):
+        for proposal in self.query.all():
+            db.session.delete(proposal)
+        db.session.commit()
+        db.session.remove()
+        self.request_context.pop()
+
+    def test_cursor(self):
+        cursor = PaginatedAPIMixin.encode_cursor('VICTIM', 42)
+        self.assertEqual(PaginatedAPIMixin.decode_cursor(cursor), ('VICTIM', 42))
+        self.assertRaises(ValueError, PaginatedAPIMixin.decode_cursor, 'not a cursor')
+        self.assertRaises(ValueError, PaginatedAPIMixin.decode_cursor, PaginatedAPIMixin.encode_cursor('x', 'y'))
+
+    def test_sort_by_acronym(self):
+        acronyms, after = [], ''
+        while True:
+            data = Proposal.to_cursor_dict(self.query, after, 1, 'api.get_proposals', sort='acronym')
+            acronyms += [x['acronym'] for x in data['items']]
+            after = data['_meta']['next']
+            if not after:
+                break
+        self.assertEqual(acronyms, ['CURSORA', 'CURSORB', 'CURSORC'])
+
+        # a cursor on a tied sort value resumes after the id of the cursor
+        b = Proposal.query.filter_by(acronym='CURSORB').first()
+        data = Proposal.to_cursor_dict(self.query, Proposal.encode_cursor('CURSORB', b.id - 1), 10,
+                                       'api.get_proposals', sort='acronym')
+        self.assertEqual([x['acronym'] for x in data['items']], ['CURSORB', 'CURSORC'])
+        data = Proposal.to_cursor_dict(self.query, Proposal.encode_cursor('CURSORB', b.id), 10,
+                                       'api.get_proposals', sort='acronym')
+        self.assertEqual([x['acronym'] for x in data['items']], ['CURSORC'])
+
+    def test_with_total_links(self):
+        data = Proposal.to_cursor_dict(self.query, '', 1, 'api.get_proposals', sort='acronym', with_total=True)
+        self.assertEqual(data['_meta']['total_items'], 3)
+        self.assertIn('with_total=1', data['_links']['self'])
+        self.assertIn('with_total=1', data['_links']['next'])
+        data = Proposal.to_cursor_dict(self.query, '', 1, 'api.get_proposals', sort='acronym')
+        self.assertNotIn('with_total', data['_links']['next'])
+
+    def test_invalid_cursor(self):
+        self.assertRaises(ValueError, Proposal.to_cursor_dict, self.query, 'not a cursor', 1, 'api.get_proposals')
+        self.assertRaises(ValueError, Proposal.to_cursor_dict, self.query, Proposal.encode_cursor('x', 'y'), 1,
+                          'api.get_proposals', sort='acronym')
+        self.assertRaises(ValueError, Proposal.to_cursor_dict, self.query, '', 1, 'api.get_proposals', sort='title')
+        for value in (['CURSORA'], {'acronym': 'CURSORA'}, 1, True):
+            self.assertRaises(ValueError, Proposal.to_cursor_dict, self.query, Proposal.encode_cursor(value, 1), 1,
+                              'api.get_proposals', sort='acronym')
+        self.assertRaises(ValueError, Proposal.to_cursor_dict, self.query, Proposal.encode_cursor('1', 1), 1,
+                          'api.get_proposals')
+
+    def test_users_cursor(self):
+        user = User(username='cursorcase')
+        db.session.add(user)
+        db.session.commit()
+        headers = {'Authorization': f'Bearer {user.get_token()}'}
+        client = self.app.test_client()
+        response = client.get('/api/users?after=&per_page=100', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('cursorcase', [x['username'] for x in response.get_json()['items']])
+        cursor = User.encode_cursor([1], 1)
+        self.assertEqual(client.get(f'/api/users?after={cursor}', headers=headers).status_code, 400)
+        db.session.delete(user)
+        db.session.commit()
+
+
+@unittest.skipIf(shutil.which('pandoc') is None, 'pandoc is not installed')
+class ExportCase(unittest.TestCase):
+    acronym = 'EXPORTCASE'
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        p = Proposal(acronym=self.acronym, title='Export Case', description=lorem.text(), budget=10,
+                     action_type='IA', call='HEU', topic='LC-TT-3-51', start_date=datetime.today(),
+                     duration_months=12, indirect_costs_rate=0.25)
+        p.working_packages.append(WP(number=1, title='Export', description=lorem.text(), start_month=0,
+                                     end_month=6))
+        db.session.add(p)
+        db.session.commit()
+        self.proposal_id = p.id
+
+    def tearDown(self):
+        db.session.delete(Proposal.query.get(self.proposal_id))
+        db.session.commit()
+        db.session.remove()
+        shutil.rmtree(os.path.join(self.app.root_path, self.app.config['DOWNLOAD_FOLDER'], self.acronym),
+                      ignore_errors=True)
+        self.app_context.pop()
+
+    def test_export_task(self):
+        # RQ jobs run under an app context only, without a request context
+        path = tasks.export_proposal(self.proposal_id, 'md')
+        self.assertTrue(os.path.exists(path))
+        with open(path) as file:
+            self.assertIn('Export Case', file.read())
+
+    def test_bulk_export_command(self):
+        cli.register(self.app)
+        with tempfile.TemporaryDirectory() as folder:
+            output = os.path.join(folder, 'export.zip')
+            result = self.app.test_cli_runner().invoke(args=['export', 'bulk', output, '--format', 'md'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with zipfile.ZipFile(output) as archive:
+                names = archive.namelist()
+        self.assertIn(f'{self.acronym}.md', names)
+        self.assertFalse([x for x in names if x.endswith('.error.txt')])
+
+    def test_bulk_export_roles(self):
+        user = User(username='exportcase', access=ACCESS['user'])
+        read_only = Proposal(acronym=f'{self.acronym}RO', title='Read Only', description='', budget=10,
+                             action_type='IA', call='HEU', topic='LC-TT-3-51', start_date=datetime.today(),
+                             duration_months=12, indirect_costs_rate=0.25)
+        db.session.add_all([user, read_only])
+        db.session.commit()
+        Proposal.query.get(self.proposal_id).add_user(user, ROLES['edit'])
+        read_only.add_user(user, ROLES['read_only'])
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+        response = client.get('/export/bulk?format=md')
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            names = archive.namelist()
+        self.assertEqual(names, [f'{self.acronym}.md'])
+        for proposal in Proposal.query.filter(Proposal.id.in_([self.proposal_id, read_only.id])):
+            proposal.remove_user(user)
+        db.session.delete(read_only)
+        db.session.delete(user)
+        db.session.commit()
+
+
+class SearchHooksCase(unittest.TestCase):
+    class RecordingQueue:
+        def __init__(self):
+            self.jobs = []
+
+        def enqueue(self, name, *args, **kwargs):
+            self.jobs.append((name, args))
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.task_queue = self.RecordingQueue()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+
+    def test_after_commit(self):
+        u = User(username='searchhooks')
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(self.app.task_queue.jobs, [])
+
+        c = Company(acronym='SEARCHHOOKS', name='Search Hooks', description='', country='IT',
+                    company_type='SME', specialisation='Indexing')
+        db.session.add(c)
+        db.session.commit()
+        company_id = c.id
+        self.assertEqual(self.app.task_queue.jobs,
+                         [('app.tasks.update_search_index', ([('company', company_id)], []))])
+
+        db.session.delete(c)
+        db.session.delete(u)
+        db.session.commit()
+        self.assertEqual(self.app.task_queue.jobs[-1],
+                         ('app.tasks.update_search_index', ([], [('company', company_id)])))
+
+
+class VersionKeyCase(unittest.TestCase):
+    acronym = 'VERSIONCASE'
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.proposal = Proposal(acronym=self.acronym, title='Version Case', description='', budget=10,
+                                 action_type='IA', call='HEU', topic='LC-TT-3-51', start_date=datetime.today(),
+                                 duration_months=12, indirect_costs_rate=0.25)
+        self.proposal.working_packages.append(WP(number=1, title='Version', description='', start_month=0,
+                                                 end_month=6))
+        self.company = Company(acronym=self.acronym, name='Version Case', description='', country='IT',
+                               company_type='SME', specialisation='Caching')
+        db.session.add_all([self.proposal, self.company])
+        db.session.commit()
+        self.proposal.add_participant(self.company, personnel_cost=10, subcontracting_cost=0, is_coordinator=True,
+                                      other_direct_costs=0, proposal_related_text='', participant_number=1)
+        self.wp = self.proposal.working_packages.first()
+        self.wp.add_participant(self.company, person_month=3)
+
+    def tearDown(self):
+        db.session.delete(self.proposal)
+        db.session.delete(Company.query.get(self.company.id))
+        db.session.commit()
+        db.session.remove()
+        self.app_context.pop()
+
+    def test_remove_participant(self):
+        key = get_version_key(self.proposal)
+        self.wp.remove_participant(self.company)
+        self.assertNotEqual(get_version_key(self.proposal), key)
+        key = get_version_key(self.proposal)
+        self.proposal.remove_participant(self.company)
+        self.assertNotEqual(get_version_key(self.proposal), key)
+        self.assertFalse(self.proposal.is_included(self.company))
+        self.assertIsNotNone(Company.query.get(self.company.id))
+
+    def test_remove_participant_portfolio(self):
+        version = get_portfolio_version()
+        self.proposal.remove_participant(self.company)
+        self.assertNotEqual(get_portfolio_version(), version)
+
+    def test_remove_participant_etag(self):
+        user = User(username='versioncase')
+        db.session.add(user)
+        db.session.commit()
+        self.proposal.add_user(user, ROLES['read_only'])
+        headers = {'Authorization': f'Bearer {user.get_token()}'}
+        client = self.app.test_client()
+        url = f'/api/proposals/{self.proposal.id}'
+        etag = client.get(url, headers=headers).headers['ETag']
+        self.assertEqual(client.get(url, headers=dict(headers, **{'If-None-Match': etag})).status_code, 304)
+        self.proposal.remove_participant(self.company)
+        response = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.proposal.remove_user(user)
+        db.session.delete(user)
+        db.session.commit()
+
+
+class ReindexCase(unittest.TestCase):
+    acronyms = ('REINDEXA', 'REINDEXB', 'REINDEXC')
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        for acronym in self.acronyms:
+            db.session.add(Company(acronym=acronym, name=f'{acronym} Reindexed', description='', country='IT',
+                                   company_type='SME', specialisation='Reindexing'))
+        db.session.commit()
+        cli.register(self.app)
+        self.folder = tempfile.TemporaryDirectory()
+        self.checkpoint = os.path.join(self.folder.name, 'reindex.json')
+
+    def tearDown(self):
+        for company in Company.query.filter(Company.acronym.in_(self.acronyms)):
+            db.session.delete(company)
+        db.session.commit()
+        db.session.remove()
+        self.folder.cleanup()
+        self.app_context.pop()
+
+    def invoke(self, *args):
+        return self.app.test_cli_runner().invoke(args=['search', 'reindex', '--model', 'company', '--chunk-size', '1',
+                                                       '--workers', '1', '--checkpoint', self.checkpoint, *args])
+
+    def test_resume(self):
+        ids = [x[0] for x in db.session.query(Company.id).order_by(Company.id)]
+        send_bulk_payload = search.send_bulk_payload
+
+        def interrupted(payload):
+            if interrupted.calls:
+                raise RuntimeError('interrupted')
+            interrupted.calls += 1
+            send_bulk_payload(payload)
+
+        interrupted.calls = 0
+        with mock.patch('app.search.send_bulk_payload', interrupted):
+            result = self.invoke()
+        self.assertNotEqual(result.exit_code, 0)
+        with open(self.checkpoint) as file:
+            self.assertEqual(json.load(file), {'company': {'after': ids[0], 'done': False}})
+
+        result = self.invoke('--resume')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertNotIn(f'up to id {ids[0]} ', result.output)
+        self.assertIn(f'up to id {ids[-1]} ', result.output)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertEqual(fulltext_lib.query_index('company', 'reindexed', 1, 10)[1], len(self.acronyms))
+
+
+class BudgetCase(unittest.TestCase):
+    def test_budget(self):
+        budget = Budget([(1, 1, 'COPER', 'UK', 'SME', 50, 0, 22, 0.25, 'IA'),
+                         (1, 2, 'RFD', 'US', 'RTO', 10, 10, 0, 0.25, 'IA'),
+                         (2, 1, 'NUB', 'IT', 'Large', 21.5, 11, 2, 0.25, 'CSA')])
+        self.assertEqual(budget.indirect_costs.tolist(), [12.5, 5, 8.125])
+        self.assertEqual(budget.total_costs.tolist(), [84.5, 25, 42.625])
+        self.assertEqual(budget.reimbursement_rate.tolist(), [0.7, 1, 1])
+        self.assertAlmostEqual(budget.sum_by_proposal(budget.contribution)[1], 84.5 * 0.7 + 25)
+        remaining = budget.remaining({1: 100, 2: 79.8, 3: 10})
+        self.assertAlmostEqual(remaining[2], 79.8 - 42.625)
+        self.assertEqual(remaining[3], 10)
+        self.assertEqual(budget.rows()[0]['reimbursement_rate'], 70)
+        self.assertEqual(len(Budget([])), 0)
+
+
+class CalendarCase(unittest.TestCase):
+    def test_calendar(self):
+        months = ProposalCalendar(date(2021, 1, 31), 24)
+        self.assertEqual(len(months.timestamps), 25)
+        self.assertEqual(months.date(1), date(2021, 2, 28))
+        self.assertEqual(months.date(24), date(2023, 1, 31))
+        self.assertEqual(months.date(25), date(2023, 2, 28))
+        self.assertEqual(months.timestamp(25), to_timestamp(date(2023, 2, 28)))
+        self.assertEqual(months.timestamp(3), to_timestamp(date(2021, 4, 30)))
+
+
+class PrefixIndexCase(unittest.TestCase):
+    def test_match(self):
+        index = PrefixIndex(['HORIZON-CL5-2021', 'horizon-cl4-2022', 'H2020-LC-SC3', 'HORIZON-CL5-2021', None, ''])
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.match('hor', 10), ['horizon-cl4-2022', 'HORIZON-CL5-2021'])
+        self.assertEqual(index.match('HORIZON', 1), ['horizon-cl4-2022'])
+        self.assertEqual(index.match('H2', 10), ['H2020-LC-SC3'])
+        self.assertEqual(index.match('x', 10), [])
+
+
+class FulltextCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+
+    def test_query_index(self):
+        fulltext_lib.index_documents([('proposal', 1, {'title': 'Smart grids', 'description': '<p>Energy communities</p>'}),
+                                      ('proposal', 2, {'title': 'Hydrogen storage', 'description': None}),
+                                      ('wp', 1, {'title': 'Energy management', 'description': ''})])
+        self.assertEqual(fulltext_lib.query_index('proposal', 'energ', 1, 10), ([1], 1))
+        self.assertEqual(fulltext_lib.query_index('proposal', 'storage hydrogen', 1, 10), ([2], 1))
+        self.assertEqual(fulltext_lib.query_index('proposal', '<p>', 1, 10), ([], 0))
+        self.assertEqual(fulltext_lib.query_index('proposal', 'energ', 1, 10, ids=[2]), ([], 0))
+        self.assertEqual(fulltext_lib.query_index('proposal', 'energ', 1, 10, ids=[1, 2]), ([1], 1))
+        self.assertEqual(fulltext_lib.query_index('proposal', 'energ', 1, 10, ids=[]), ([], 0))
+        fulltext_lib.index_documents([('proposal', 2, {'title': 'Wind farms', 'description': None})])
+        self.assertEqual(fulltext_lib.query_index('proposal', 'hydrogen', 1, 10), ([], 0))
+        fulltext_lib.remove_documents([('wp', 1)])
+        self.assertEqual(fulltext_lib.query_index('wp', 'energy', 1, 10), ([], 0))
+
+    def test_escape_like(self):
+        self.assertEqual(fulltext_lib.escape_like('smart_grid'), 'smart\\_grid')
+        self.assertEqual(fulltext_lib.escape_like('100%'), '100\\%')
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)